@@ -0,0 +1,68 @@
+"""Measure how long ``import cli_ui`` takes, using ``python -X importtime``.
+
+Each measurement runs in a fresh interpreter. The slowest modules
+imported along with cli_ui are listed, to spot new heavy imports.
+
+Usage::
+
+    poetry run python benchmarks/bench_import.py [--runs 10] [--budget-ms 50]
+
+Exits with a non-zero status if the median import time exceeds the budget.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict
+
+
+def import_times(module: str) -> Dict[str, int]:
+    """Cumulative import time of the module and of the modules
+    it imported, in microseconds"""
+    env = dict(os.environ)
+    # Measure what users get, with the bytecode cache
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        check=True,
+        capture_output=True,
+        text=True,
+        env=env,
+    )
+    res: Dict[str, int] = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not name.startswith("  "):
+            # Imported by the interpreter itself, or the module we measure
+            if name.strip() != module:
+                res.clear()
+                continue
+        res[name.strip()] = int(cumulative)
+    return res
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--budget-ms", type=float)
+    args = parser.parse_args()
+
+    # The first run may have to write the bytecode cache
+    import_times("cli_ui")
+    runs = [import_times("cli_ui") for _ in range(args.runs)]
+    total = statistics.median(run["cli_ui"] for run in runs) / 1000
+    print(f"import cli_ui: {total:.1f} ms (median of {args.runs} runs)")
+    print("slowest modules:")
+    last = runs[-1]
+    for name in sorted(last, key=last.__getitem__, reverse=True)[1:11]:
+        print(f"  {name:<30} {last[name] / 1000:.1f} ms")
+    if args.budget_ms is not None and total > args.budget_ms:
+        sys.exit(f"Over budget: {total:.1f} ms > {args.budget_ms} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""Compare a bare loop with the same loop wrapped in cli_ui.track().
+
+Usage::
+
+    poetry run python benchmarks/bench_progress.py
+"""
+
+import io
+import time
+
+import cli_ui
+
+NUM_ITEMS = 10_000_000
+
+
+class FakeTTY(io.StringIO):
+    def isatty(self) -> bool:
+        return True
+
+
+def bare_loop() -> None:
+    for _ in range(NUM_ITEMS):
+        pass
+
+
+def tracked_loop() -> None:
+    # Use a fake terminal so that the line is actually drawn
+    cli_ui.setup(color="always")
+    for _ in cli_ui.track(range(NUM_ITEMS), "Working", fileobj=FakeTTY()):
+        pass
+
+
+def main() -> None:
+    for func in (bare_loop, tracked_loop):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        per_item = elapsed / NUM_ITEMS * 1e9
+        print(f"{func.__name__:<15} {elapsed:.2f}s ({per_item:.0f} ns per item)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""Compare rendering both flavors of a message with rendering only one,
+and with using a pre-rendered template.
+
+Usage::
+
+    poetry run python benchmarks/bench_render.py
+"""
+
+import timeit
+
+import cli_ui
+
+TOKENS = (
+    cli_ui.bold,
+    cli_ui.blue,
+    "::",
+    cli_ui.reset,
+    "Processing",
+    cli_ui.green,
+    "some/path/to/a/file.txt",
+    cli_ui.reset,
+    cli_ui.check,
+)
+
+NUMBER = 100_000
+
+
+def both_flavors() -> None:
+    cli_ui.process_tokens(TOKENS)
+
+
+def one_flavor() -> None:
+    cli_ui.RenderedTokens(TOKENS).without_color
+
+
+HEAD = TOKENS[:4]
+REST = TOKENS[4:]
+TEMPLATE = cli_ui.template(*HEAD)
+
+
+def without_template() -> None:
+    cli_ui.RenderedTokens(HEAD + REST).without_color
+
+
+def with_template() -> None:
+    cli_ui.RenderedTokens((TEMPLATE,) + REST).without_color
+
+
+def main() -> None:
+    for func in (both_flavors, one_flavor, without_template, with_template):
+        elapsed = timeit.timeit(func, number=NUMBER)
+        per_call = elapsed / NUMBER * 1e6
+        print(f"{func.__name__:<20} {per_call:.2f} µs per call")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""Measure message throughput as the number of writing threads grows.
+
+Usage::
+
+    poetry run python benchmarks/bench_threads.py
+"""
+
+import io
+import threading
+import time
+
+import cli_ui
+
+MESSAGES_PER_THREAD = 20_000
+
+
+def run(num_threads: int) -> float:
+    stream = io.StringIO()
+
+    def worker() -> None:
+        for i in range(MESSAGES_PER_THREAD):
+            cli_ui.info("item", end=" ", fileobj=stream)
+            cli_ui.info(i, fileobj=stream)
+
+    threads = [threading.Thread(target=worker) for _ in range(num_threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return num_threads * MESSAGES_PER_THREAD / elapsed
+
+
+def main() -> None:
+    for num_threads in (1, 2, 4, 8, 16, 32):
+        lines_per_second = run(num_threads)
+        print(f"{num_threads:>2} threads: {lines_per_second:,.0f} lines/s")
+
+
+if __name__ == "__main__":
+    main()
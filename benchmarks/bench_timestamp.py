@@ -0,0 +1,35 @@
+"""Compare the cost of the time stamp prefix with the previous
+implementation, which called datetime.now().strftime() for every message.
+
+Usage::
+
+    poetry run python benchmarks/bench_timestamp.py
+"""
+
+import datetime
+import timeit
+
+import cli_ui
+
+NUMBER = 200_000
+
+
+def strftime_each_time() -> None:
+    datetime.datetime.now().strftime("[%Y-%m-%d %H:%M:%S] ")
+
+
+def cached() -> None:
+    cli_ui._timestamp_prefix()
+
+
+def main() -> None:
+    elapsed = timeit.timeit(strftime_each_time, number=NUMBER)
+    print(f"{'previous':<15} {elapsed / NUMBER * 1e9:.0f} ns per call")
+    for timestamp_format in ("seconds", "milliseconds", "relative"):
+        cli_ui.setup(timestamp=True, timestamp_format=timestamp_format)
+        elapsed = timeit.timeit(cached, number=NUMBER)
+        print(f"{timestamp_format:<15} {elapsed / NUMBER * 1e9:.0f} ns per call")
+
+
+if __name__ == "__main__":
+    main()
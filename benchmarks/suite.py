@@ -0,0 +1,246 @@
+"""Benchmark suite for the hot paths of cli_ui.
+
+Each case is timed with timeit, and the best of several runs is kept.
+Results are written as JSON, and can be compared with a baseline from
+a previous run: a case is a regression when it got slower by more than
+the threshold.
+
+Timings are also divided by the time of a pure-Python calibration loop,
+measured right before each case. Comparisons use those normalized
+timings, so that a baseline recorded on one machine, or while the
+machine was busier, is still meaningful.
+
+Usage::
+
+    just bench                 # compare with benchmarks/baseline.json
+    just bench-baseline        # update benchmarks/baseline.json
+    poetry run python benchmarks/suite.py --full --only table
+
+``--full`` adds the slow cases, such as a table with 1M rows.
+"""
+
+import argparse
+import io
+import json
+import platform
+import re
+import sys
+import timeit
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+import cli_ui
+
+
+class FakeTTY(io.StringIO):
+    def isatty(self) -> bool:
+        return True
+
+
+class Case(NamedTuple):
+    name: str
+    func: Callable[[], Any]
+    number: int
+    repeat: int = 5
+    config: Dict[str, Any] = {}
+    slow: bool = False
+    # Called once before timing, to build the input data
+    prepare: Optional[Callable[[], None]] = None
+
+
+def calibration() -> None:
+    total = 0
+    for i in range(1000):
+        total += i
+
+
+def message(fileobj: io.StringIO) -> Callable[[], None]:
+    def func() -> None:
+        cli_ui.info(
+            cli_ui.green, "Processing", cli_ui.reset, "file.txt", 42, fileobj=fileobj
+        )
+        fileobj.seek(0)
+        fileobj.truncate()
+
+    return func
+
+
+LONG_TOKENS = [cli_ui.bold, "word", cli_ui.reset, 42, cli_ui.check] * 200
+
+
+def process_tokens() -> None:
+    cli_ui.process_tokens(LONG_TOKENS)
+
+
+class Table:
+    def __init__(self, num_rows: int):
+        self.num_rows = num_rows
+        self.rows: List[Any] = []
+
+    def prepare(self) -> None:
+        self.rows = [
+            [(cli_ui.bold, "name%d" % i), (cli_ui.green, i * 1.5)]
+            for i in range(self.num_rows)
+        ]
+
+    def __call__(self) -> None:
+        cli_ui.info_table(self.rows, headers=["name", "score"], fileobj=io.StringIO())
+
+
+def table_case(name: str, num_rows: int, **kwargs: Any) -> Case:
+    table = Table(num_rows)
+    return Case(name, table, prepare=table.prepare, **kwargs)
+
+
+CHOICES = ["package-%d-%s" % (i, "abcdefgh"[i % 8] * (i % 5)) for i in range(50_000)]
+
+
+def did_you_mean() -> None:
+    # The index of the choices is cached after the first call
+    cli_ui.did_you_mean("Unknown package", "pakcage-4242-cc", CHOICES)
+
+
+def suggestion_index() -> None:
+    cli_ui.SuggestionIndex(CHOICES).suggest("pakcage-4242-cc")
+
+
+def info_count_one_line() -> Callable[[], None]:
+    fileobj = FakeTTY()
+    i = 0
+
+    def func() -> None:
+        nonlocal i
+        cli_ui.info_count(i % 1000, 1000, "item", one_line=True, fileobj=fileobj)
+        i += 1
+        if i % 1000 == 0:
+            fileobj.seek(0)
+            fileobj.truncate()
+
+    return func
+
+
+def timer() -> None:
+    with cli_ui.Timer("something"):
+        pass
+
+
+CASES = [
+    Case("calibration", calibration, number=1_000),
+    Case("info/plain", message(io.StringIO()), number=50_000),
+    Case("info/color", message(FakeTTY()), number=50_000, config={"color": "always"}),
+    Case(
+        "info/timestamp",
+        message(io.StringIO()),
+        number=50_000,
+        config={"timestamp": True},
+    ),
+    Case(
+        "info/jsonl", message(io.StringIO()), number=50_000, config={"format": "jsonl"}
+    ),
+    Case("info/stats", message(io.StringIO()), number=50_000, config={"stats": True}),
+    Case("process_tokens/1000", process_tokens, number=2_000),
+    table_case("info_table/10", 10, number=2_000),
+    table_case("info_table/10k", 10_000, number=2, repeat=3),
+    table_case("info_table/1M", 1_000_000, number=1, repeat=1, slow=True),
+    Case("did_you_mean/50k", did_you_mean, number=20),
+    Case("SuggestionIndex/50k", suggestion_index, number=1, repeat=3, slow=True),
+    Case(
+        "info_count/one_line",
+        info_count_one_line(),
+        number=50_000,
+        config={"color": "always"},
+    ),
+    # Timer writes to stdout: only measure its own overhead
+    Case("Timer", timer, number=50_000, config={"quiet": True}),
+]
+
+
+def run_case(case: Case) -> float:
+    """Return the best time per call, in seconds"""
+    if case.prepare:
+        case.prepare()
+    cli_ui.setup(**case.config)
+    try:
+        times = timeit.repeat(case.func, number=case.number, repeat=case.repeat)
+    finally:
+        cli_ui.setup()
+    return min(times) / case.number
+
+
+def run(cases: List[Case]) -> Dict[str, Any]:
+    results = {}
+    for case in cases:
+        calibration_time = run_case(CASES[0])
+        seconds = run_case(case)
+        results[case.name] = {
+            "seconds": seconds,
+            "normalized": seconds / calibration_time,
+        }
+        print(f"{case.name:<25} {format_time(seconds):>12}", flush=True)
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+
+def format_time(seconds: float) -> str:
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("µs", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f} {unit}"
+    return f"{seconds / 1e-9:.0f} ns"
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> bool:
+    """Print the ratio of each case to the baseline, and return
+    False if any of them is over the threshold"""
+    ok = True
+    print()
+    print(f"{'case':<25} {'vs baseline':>12}")
+    for name, result in report["results"].items():
+        previous = baseline["results"].get(name)
+        if previous is None:
+            print(f"{name:<25} {'new':>12}")
+            continue
+        ratio = result["normalized"] / previous["normalized"]
+        status = ""
+        if ratio > threshold:
+            status = "  REGRESSION"
+            ok = False
+        print(f"{name:<25} {ratio:>11.2f}x{status}")
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--only", help="only run cases matching this pattern")
+    parser.add_argument("--full", action="store_true", help="include slow cases")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="compare with this JSON file")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.5,
+        help="maximum slowdown allowed when comparing (default: 1.5)",
+    )
+    args = parser.parse_args()
+
+    cases = [case for case in CASES[1:] if args.full or not case.slow]
+    if args.only:
+        cases = [case for case in cases if re.search(args.only, case.name)]
+    report = run(cases)
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+            fp.write("\n")
+
+    baseline: Optional[Dict[str, Any]] = None
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+    if baseline and not compare(report, baseline, args.threshold):
+        sys.exit("Some cases are slower than the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,39 @@
-import argparse
-import datetime
-import difflib
+import atexit
+import bisect
+import codecs
+import collections
+import contextvars
 import functools
-import getpass
-import inspect
+import heapq
 import io
+import itertools
+import math
 import os
+import queue
 import re
-import shutil
 import sys
+import threading
 import time
-import traceback
-from operator import itemgetter
-from typing import IO, Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
-
-import colorama
-import tabulate
-import unidecode
-
-ConfigValue = Union[None, bool, str]
+import weakref
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+)
+
+ConfigValue = Union[None, bool, str, int, float]
 FileObj = IO[str]
 
 # Global variable to store configuration
@@ -29,22 +44,32 @@ CONFIG: Dict[str, ConfigValue] = {
     "color": "auto",
     "title": "auto",
     "timestamp": False,
+    "timestamp_format": "seconds",
+    "buffering": "never",
+    "buffer_size": 8192,
+    "flush_interval": 1.0,
+    "background": False,
+    "queue_size": 1024,
+    "backpressure": "block",
+    "format": "text",
+    "timer_summary": False,
+    "warning_limit": None,
+    "error_limit": None,
+    "flood_window": 60.0,
     "record": False,  # used for testing
 }
 
-
-# used for testing
-_MESSAGES = []
-
-# so that we don't re-compute this variable over
-# and over again:
-_ENABLE_XTERM_TITLE = None
+# so that we don't call isatty() and friends over
+# and over again - see _stream_capabilities()
+_CAPABILITIES: Dict[int, "_StreamCapabilities"] = {}
 
 
 if os.name == "nt":
     # On Windows using `isatty()` does *not* work reliably,
     # so we always setup colorama.
     # See colors_enabled() for details
+    import colorama
+
     colorama.init()
 
 
@@ -52,6 +77,10 @@ if os.name == "nt":
 # or anything that can be converted to string.
 Token = Any
 
+# Default stream of the message functions. Bound when cli_ui is imported,
+# so it may differ from sys.stdout when sys.stdout is replaced later on
+_DEFAULT_STDOUT = sys.stdout
+
 
 def setup(
     *,
@@ -60,6 +89,19 @@ def setup(
     color: str = "auto",
     title: str = "auto",
     timestamp: bool = False,
+    timestamp_format: str = "seconds",
+    buffering: str = "never",
+    buffer_size: int = 8192,
+    flush_interval: float = 1.0,
+    background: bool = False,
+    queue_size: int = 1024,
+    backpressure: str = "block",
+    format: str = "text",
+    stats: bool = False,
+    timer_summary: bool = False,
+    warning_limit: Optional[int] = None,
+    error_limit: Optional[int] = None,
+    flood_window: float = 60.0,
 ) -> None:
     """Configure behavior of message functions.
 
@@ -70,8 +112,80 @@ def setup(
                   By default ('auto'), only use color when output is a terminal.
     :param title: Ditto for setting terminal title
     :param timestamp: Whether to prefix every message with a time stamp
+    :param timestamp_format: Choices: 'seconds', 'milliseconds', 'relative', or
+                  a :func:`time.strftime` format. 'relative' is the number of
+                  seconds since cli_ui was imported, measured with a monotonic
+                  clock.
+    :param buffering: Choices: 'never' or 'always'. Whether to keep messages
+                  written to pipes and files in the stream buffer instead of
+                  flushing after each of them. By default ('never'), flush
+                  after each message, so that messages are not written after
+                  the output of subprocesses or of other libraries. With
+                  'always', call :func:`flush` before running a subprocess
+                  which writes to the same stream. Messages written to a
+                  terminal are always flushed right away.
+    :param buffer_size: When buffering, flush once that many characters are pending
+    :param flush_interval: When buffering, flush when the oldest pending message
+                  is older than that many seconds, even if no other message
+                  is written
+    :param background: Whether to write messages from a dedicated thread, so
+                  that callers never wait for slow output streams
+    :param queue_size: How many messages can wait for the background thread
+    :param backpressure: Choices: 'block', 'drop-oldest', or 'drop'. What to do
+                  when the queue of the background thread is full: wait for a
+                  free slot, discard the oldest message, or discard the new one.
+                  See :func:`dropped_messages`.
+    :param format: Choices: 'text' or 'jsonl'. With 'jsonl', each message is
+                  written as a JSON object on its own line, with its time,
+                  level, stream and plain text. Colors, terminal titles and
+                  time stamp prefixes are disabled.
+    :param stats: Whether to collect statistics about messages and writes.
+                  See :func:`stats`.
+    :param timer_summary: Whether to display the statistics of every
+                  :class:`Timer` when the interpreter exits.
+                  See :func:`info_timers`.
+    :param warning_limit: How many warnings from the same line of code can be
+                  displayed within ``flood_window``. The next ones are
+                  suppressed and counted, and a summary is displayed once the
+                  window is over, or when the interpreter exits.
+                  By default, there is no limit.
+    :param error_limit: Ditto for errors. :func:`fatal` is never suppressed.
+    :param flood_window: Duration of the windows, in seconds
     """
-    _setup(verbose=verbose, quiet=quiet, color=color, title=title, timestamp=timestamp)
+    global _STATS
+    # Do not lose track of messages suppressed with the previous settings
+    _FLOOD_CONTROL.report()
+    # Make sure messages already queued are written with the previous settings
+    _stop_background_writer()
+    _CAPABILITIES.clear()
+    if format == "jsonl":
+        # Records only contain plain text
+        color = "never"
+        title = "never"
+    _setup(
+        verbose=verbose,
+        quiet=quiet,
+        color=color,
+        title=title,
+        timestamp=timestamp,
+        timestamp_format=timestamp_format,
+        buffering=buffering,
+        buffer_size=buffer_size,
+        flush_interval=flush_interval,
+        background=background,
+        queue_size=queue_size,
+        backpressure=backpressure,
+        format=format,
+        timer_summary=timer_summary,
+        warning_limit=warning_limit,
+        error_limit=error_limit,
+        flood_window=flood_window,
+    )
+    if not stats:
+        _STATS = None
+    elif _STATS is None:
+        # Keep the counters when setup() is called again
+        _STATS = _Stats()
 
 
 def _setup(**kwargs: ConfigValue) -> None:
@@ -91,23 +205,25 @@ class Color:
 
 
 # fmt: off
-reset     = Color("reset", colorama.Style.RESET_ALL)
-bold      = Color("bold", colorama.Style.BRIGHT)
-faint     = Color("dim", colorama.Style.DIM)
+# Same codes as colorama.Style and colorama.Fore, without having
+# to import colorama
+reset     = Color("reset", '\x1b[0m')
+bold      = Color("bold", '\x1b[1m')
+faint     = Color("dim", '\x1b[2m')
 # for some reason those are not in colorama
 standout  = Color("standout", '\x1b[3m')
 underline = Color("underline", '\x1b[4m')
 blink     = Color("blink", '\x1b[5m')
 overline  = Color("overline", '\x1b[6m')
 
-black   = Color("black", colorama.Fore.BLACK)
-red     = Color("red", colorama.Fore.RED)
-green   = Color("green", colorama.Fore.GREEN)
-yellow  = Color("yellow", colorama.Fore.YELLOW)
-blue    = Color("blue", colorama.Fore.BLUE)
-magenta = Color("magenta", colorama.Fore.MAGENTA)
-cyan    = Color("cyan", colorama.Fore.CYAN)
-white   = Color("white", colorama.Fore.WHITE)
+black   = Color("black", '\x1b[30m')
+red     = Color("red", '\x1b[31m')
+green   = Color("green", '\x1b[32m')
+yellow  = Color("yellow", '\x1b[33m')
+blue    = Color("blue", '\x1b[34m')
+magenta = Color("magenta", '\x1b[35m')
+cyan    = Color("cyan", '\x1b[36m')
+white   = Color("white", '\x1b[37m')
 
 # backward compatibility:
 brown = yellow      # used by ui.warning
@@ -124,16 +240,59 @@ darkyellow = yellow
 # fmt: on
 
 
+# Unicode form -> ASCII form of every UnicodeSequence, see _encodable()
+_ASCII_FORMS: Dict[str, str] = {}
+
+# Other characters -> result of unidecode, since the same ones tend
+# to come up in many messages
+_TRANSLITERATED: Dict[str, str] = {}
+
+
+def _ascii_replacement(error: UnicodeError) -> Tuple[str, int]:
+    # Error handler used to encode text, so that only the characters
+    # the stream does not support are transliterated
+    if not isinstance(error, UnicodeEncodeError):
+        raise error
+    start, end = error.start, error.end
+    span = error.object[start:end]
+    replacement = _ASCII_FORMS.get(span) or _TRANSLITERATED.get(span)
+    if replacement is None:
+        import unidecode
+
+        replacement = "".join(
+            _ASCII_FORMS.get(char) or unidecode.unidecode(char) for char in span
+        )
+        if len(_TRANSLITERATED) > 4096:
+            _TRANSLITERATED.clear()
+        _TRANSLITERATED[span] = replacement
+    return (replacement, end)
+
+
+codecs.register_error("cli_ui.ascii", _ascii_replacement)
+
+
+def _encodable(text: str, encoding: str) -> str:
+    """Replace the characters that cannot be encoded with their ASCII form"""
+    try:
+        return text.encode(encoding, "cli_ui.ascii").decode(encoding)
+    except LookupError:
+        return text.encode("ascii", "cli_ui.ascii").decode("ascii")
+
+
 # Other nice-to-have characters:
 class UnicodeSequence:
-    """Represent a sequence containing a color followed by a Unicode symbol"""
+    """Represent a sequence containing a color followed by a Unicode symbol.
+
+    The ASCII form is written instead on streams which cannot
+    encode the Unicode one.
+    """
 
     def __init__(self, color: Color, as_unicode: str, as_ascii: str):
-        if os.name == "nt":
-            self.as_string = as_ascii
-        else:
-            self.as_string = as_unicode
+        self.as_unicode = as_unicode
+        self.as_ascii = as_ascii
+        self.as_string = as_unicode
         self.color = color
+        _ASCII_FORMS[as_unicode] = as_ascii
 
     def tuple(self) -> Tuple[Token, ...]:
         return (reset, self.color, self.as_string, reset)
@@ -158,6 +317,69 @@ class Symbol(UnicodeSequence):
         return f"Symbol({self.as_string})"
 
 
+class _StreamCapabilities:
+    """What a stream supports. Computed once per stream, see
+    :func:`_stream_capabilities`"""
+
+    def __init__(self, fileobj: FileObj):
+        self.fileobj = fileobj
+        try:
+            self.isatty = fileobj.isatty()
+        except (AttributeError, ValueError):
+            self.isatty = False
+        self.encoding = getattr(fileobj, "encoding", None) or "utf-8"
+        self._unicode: Optional[bool] = None
+        self._columns: Optional[int] = None
+
+    @property
+    def unicode(self) -> bool:
+        """Whether the Unicode symbols can be written as is"""
+        if self._unicode is None:
+            try:
+                "✓❌…".encode(self.encoding)
+                self._unicode = True
+            except (UnicodeEncodeError, LookupError):
+                self._unicode = False
+        return self._unicode
+
+    @property
+    def columns(self) -> int:
+        """Width of the terminal, or of the default terminal if the
+        stream is not one"""
+        if self.isatty:
+            # Terminals can be resized at any time
+            return self._get_columns()
+        if self._columns is None:
+            self._columns = self._get_columns()
+        return self._columns
+
+    def _get_columns(self) -> int:
+        # Same precedence as shutil.get_terminal_size()
+        try:
+            return int(os.environ["COLUMNS"])
+        except (KeyError, ValueError):
+            pass
+        try:
+            return os.get_terminal_size(self.fileobj.fileno()).columns
+        except (AttributeError, OSError, ValueError):
+            import shutil
+
+            return shutil.get_terminal_size().columns
+
+
+def _stream_capabilities(fileobj: FileObj) -> _StreamCapabilities:
+    # Streams are looked up by identity, so replacing sys.stdout
+    # (like pytest does) means a new entry
+    capabilities = _CAPABILITIES.get(id(fileobj))
+    if capabilities is None or capabilities.fileobj is not fileobj:
+        if len(_CAPABILITIES) > 64:
+            # Do not keep references to lots of short-lived streams
+            _CAPABILITIES.clear()
+        capabilities = _StreamCapabilities(fileobj)
+        _CAPABILITIES[id(fileobj)] = capabilities
+    return capabilities
+
+
 def colors_enabled(fileobj: FileObj) -> bool:
     if CONFIG["color"] == "never":
         return False
@@ -168,73 +390,1032 @@ def colors_enabled(fileobj: FileObj) -> bool:
         # because there are two many ways for this to go wrong
         return False
     else:
-        return fileobj.isatty()
+        return _stream_capabilities(fileobj).isatty
+
+
+def title_enabled(fileobj: FileObj) -> bool:
+    if CONFIG["title"] == "never":
+        return False
+    if CONFIG["title"] == "always":
+        return True
+    return colors_enabled(fileobj)
+
+
+def _title_string(mystr: str) -> str:
+    return "\x1b]0;%s\x07" % mystr
 
 
 def write_title_string(mystr: str, fileobj: FileObj) -> None:
-    if not colors_enabled(fileobj):
+    if not title_enabled(fileobj):
         return
-    mystr = "\x1b]0;%s\x07" % mystr
-    fileobj.write(mystr)
-    fileobj.flush()
+    write_and_flush(fileobj, _title_string(mystr))
 
 
-def process_tokens(
-    tokens: Sequence[Token], *, end: str = "\n", sep: str = " "
-) -> Tuple[str, str]:
-    """Returns two strings from a list of tokens.
-    One containing ASCII escape codes, the other
-    only the 'normal' characters
-
-    """
+def _flatten_tokens(tokens: Sequence[Token]) -> List[Token]:
     # Flatten the list of tokens in case some of them are of
     # class UnicodeSequence:
     flat_tokens: List[Token] = []
     for token in tokens:
         if isinstance(token, UnicodeSequence):
             flat_tokens.extend(token.tuple())
+        elif isinstance(token, Template):
+            flat_tokens.extend(token.tokens)
+        elif isinstance(token, Lazy):
+            flat_tokens.extend(_flatten_tokens([token.value()]))
         else:
             flat_tokens.append(token)
+    return flat_tokens
+
 
-    with_color = _process_tokens(flat_tokens, end=end, sep=sep, color=True)
-    without_color = _process_tokens(flat_tokens, end=end, sep=sep, color=False)
-    return (with_color, without_color)
+_TIMESTAMP_PATTERNS = {
+    "seconds": "[%Y-%m-%d %H:%M:%S] ",
+    # milliseconds are appended to the cached string, see _timestamp_prefix()
+    "milliseconds": "[%Y-%m-%d %H:%M:%S",
+}
+
+_START_TIME = time.monotonic()
+
+# (second, format, strftime result) - formatting the date is the
+# expensive part, so only do it when the second changes
+_TIMESTAMP_CACHE: Tuple[int, Any, str] = (-1, None, "")
+
+
+def _timestamp_prefix() -> str:
+    global _TIMESTAMP_CACHE
+    if not CONFIG["timestamp"]:
+        return ""
+    timestamp_format = CONFIG["timestamp_format"]
+    if timestamp_format == "relative":
+        return "[+%.3fs] " % (time.monotonic() - _START_TIME)
+    now = time.time()
+    second = int(now)
+    cached_second, cached_format, res = _TIMESTAMP_CACHE
+    if second != cached_second or timestamp_format != cached_format:
+        pattern = _TIMESTAMP_PATTERNS.get(str(timestamp_format))
+        if pattern is None:
+            pattern = "[%s] " % timestamp_format
+        res = time.strftime(pattern, time.localtime(second))
+        _TIMESTAMP_CACHE = (second, timestamp_format, res)
+    if timestamp_format == "milliseconds":
+        res += ".%03d] " % ((now - second) * 1000)
+    return res
+
+
+class Template:
+    """A list of constant tokens, rendered once and re-used as the
+    beginning of many messages.
+
+    Pass it as the *first* token of any message function, followed
+    by the variable tokens::
+
+        >>> done = cli_ui.Template(cli_ui.green, "Done:", cli_ui.reset)
+        >>> cli_ui.info(done, "foo")
+        >>> cli_ui.info(done, "bar")
+
+    Used anywhere else, it is expanded like a regular list of tokens.
+    """
+
+    def __init__(self, *tokens: Token):
+        self.tokens = _flatten_tokens(tokens)
+        # sep -> (open colored, open plain, closed colored, closed plain)
+        self._compiled: Dict[str, Tuple[str, str, str, str]] = {}
+
+    def head(self, sep: str, *, color: bool, closed: bool) -> str:
+        """Return the pre-rendered tokens.
+
+        :param closed: True when no token follows the template,
+                       in which case the last separator is omitted
+        """
+        compiled = self._compiled.get(sep)
+        if compiled is None:
+            compiled = self._compile(sep)
+            self._compiled[sep] = compiled
+        return compiled[closed * 2 + (not color)]
+
+    def _compile(self, sep: str) -> Tuple[str, str, str, str]:
+        colored: List[str] = []
+        plain: List[str] = []
+        for token in self.tokens:
+            if isinstance(token, Color):
+                colored.append(token.code)
+            else:
+                text = str(token) + sep
+                colored.append(text)
+                plain.append(text)
+        open_colored = "".join(colored)
+        open_plain = "".join(plain)
+        if self.tokens and not isinstance(self.tokens[-1], Color) and sep:
+            # Same rule as for regular tokens: no separator after
+            # the last one
+            return (
+                open_colored,
+                open_plain,
+                open_colored[: -len(sep)],
+                open_plain[: -len(sep)],
+            )
+        return (open_colored, open_plain, open_colored, open_plain)
+
+    def __repr__(self) -> str:
+        return f"Template({self.tokens!r})"
+
+
+def template(*tokens: Token) -> Template:
+    """Pre-render a list of constant tokens. See :class:`Template`"""
+    return Template(*tokens)
+
+
+class Lazy:
+    """A token computed only when the message is actually written.
+
+    The function is called with the given arguments the first time
+    the message is rendered, and its result is used as a token::
+
+        >>> cli_ui.debug("state:", cli_ui.Lazy(pprint.pformat, state))
+
+    Nothing is computed if the message is filtered out, for instance
+    when verbose mode is off.
+    """
+
+    _UNSET = object()
+
+    def __init__(self, func: Callable[..., Token], *args: Any, **kwargs: Any):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self._value: Token = Lazy._UNSET
+
+    def value(self) -> Token:
+        if self._value is Lazy._UNSET:
+            self._value = self.func(*self.args, **self.kwargs)
+        return self._value
+
+    def __str__(self) -> str:
+        return str(self.value())
+
+
+def lazy(func: Callable[..., Token], *args: Any, **kwargs: Any) -> Lazy:
+    """Defer the computation of a token. See :class:`Lazy`"""
+    return Lazy(func, *args, **kwargs)
+
+
+class RenderedTokens:
+    """Lazily render a list of tokens.
+
+    The colored and the plain strings are only computed when
+    they are first accessed, and cached afterwards. When both
+    are needed, use :meth:`both` so that the tokens are only
+    walked once.
+
+    Unpacking works like the tuple returned by :func:`process_tokens`::
+
+        >>> with_color, without_color = cli_ui.RenderedTokens(tokens)
+    """
+
+    def __init__(self, tokens: Sequence[Token], *, end: str = "\n", sep: str = " "):
+        self.template: Optional[Template] = None
+        if tokens and isinstance(tokens[0], Template):
+            self.template = tokens[0]
+            tokens = tokens[1:]
+        self.tokens = _flatten_tokens(tokens)
+        self.end = end
+        self.sep = sep
+        self._prefix: Optional[str] = None
+        self._with_color: Optional[str] = None
+        self._without_color: Optional[str] = None
+
+    @property
+    def prefix(self) -> str:
+        # Computed once, so that both flavors share the same time stamp
+        if self._prefix is None:
+            self._prefix = _timestamp_prefix()
+        return self._prefix
+
+    @property
+    def with_color(self) -> str:
+        if self._with_color is None:
+            self._with_color = self._render(color=True)
+        return self._with_color
+
+    @property
+    def without_color(self) -> str:
+        if self._without_color is None:
+            self._without_color = self._render(color=False)
+        return self._without_color
+
+    def get(self, color: bool) -> str:
+        """Return the colored or the plain string"""
+        return self.with_color if color else self.without_color
+
+    def both(self) -> Tuple[str, str]:
+        """Return the colored and the plain strings, in a single pass"""
+        if self._with_color is None and self._without_color is None:
+            colored: List[str] = [self.prefix]
+            plain: List[str] = [self.prefix]
+            sep = self.sep
+            if self.template:
+                closed = not self.tokens
+                colored.append(self.template.head(sep, color=True, closed=closed))
+                plain.append(self.template.head(sep, color=False, closed=closed))
+            last = len(self.tokens) - 1
+            for i, token in enumerate(self.tokens):
+                if isinstance(token, Color):
+                    colored.append(token.code)
+                else:
+                    text = str(token)
+                    if i != last:
+                        text += sep
+                    colored.append(text)
+                    plain.append(text)
+            colored.append(self.end)
+            colored.append(reset.code)
+            plain.append(self.end)
+            self._with_color = "".join(colored)
+            self._without_color = "".join(plain)
+        return (self.with_color, self.without_color)
+
+    def _render(self, *, color: bool) -> str:
+        parts: List[str] = [self.prefix]
+        sep = self.sep
+        if self.template:
+            parts.append(self.template.head(sep, color=color, closed=not self.tokens))
+        last = len(self.tokens) - 1
+        for i, token in enumerate(self.tokens):
+            if isinstance(token, Color):
+                if color:
+                    parts.append(token.code)
+            else:
+                parts.append(str(token))
+                if i != last:
+                    parts.append(sep)
+        parts.append(self.end)
+        if color:
+            parts.append(reset.code)
+        return "".join(parts)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.both())
+
+
+def process_tokens(
+    tokens: Sequence[Token], *, end: str = "\n", sep: str = " "
+) -> Tuple[str, str]:
+    """Returns two strings from a list of tokens.
+    One containing ASCII escape codes, the other
+    only the 'normal' characters
+
+    Use :class:`RenderedTokens` if you only need one of them.
+    """
+    return RenderedTokens(tokens, end=end, sep=sep).both()
 
 
 def _process_tokens(
     tokens: Sequence[Token], *, end: str = "\n", sep: str = " ", color: bool = True
 ) -> str:
-    res = ""
+    return RenderedTokens(tokens, end=end, sep=sep).get(color)
 
-    if CONFIG["timestamp"]:
-        now = datetime.datetime.now()
-        res += now.strftime("[%Y-%m-%d %H:%M:%S] ")
 
-    for i, token in enumerate(tokens):
-        if isinstance(token, Color):
-            if color:
-                res += token.code
-        else:
-            res += str(token)
-            if i != len(tokens) - 1:
-                res += sep
-    res += end
-    if color:
-        res += reset.code
-    return res
+class _PendingWrites:
+    """Characters written to a stream since it was last flushed"""
 
+    def __init__(self, fileobj: FileObj):
+        self.fileobj = fileobj
+        self.size = 0
+        self.since = time.monotonic()
 
-def write_and_flush(fileobj: FileObj, to_write: str) -> None:
+
+# id(fileobj) -> pending writes, only for streams that need a flush
+_PENDING: Dict[int, _PendingWrites] = {}
+
+# Held while writing to or flushing a stream, so that every message
+# is written in one piece
+_WRITE_LOCK = threading.RLock()
+
+# thread ident -> id(fileobj) -> (fileobj, beginning of the current line)
+# Only for lines started while another thread had an incomplete line
+# on the same stream
+_PARTIAL_LINES: Dict[int, Dict[int, Tuple[FileObj, List[str]]]] = {}
+
+
+class _OpenLine:
+    """An incomplete line written to a stream by a thread"""
+
+    def __init__(self, owner: int, fileobj: FileObj):
+        self.owner = owner
+        self.fileobj = fileobj
+        self.since = time.monotonic()
+        # Complete lines from other threads, written after this one
+        self.waiting: List[str] = []
+        # Ends the line if it is still incomplete after _MAX_LINE_DELAY
+        self.timer: Optional[threading.Timer] = None
+
+    def wait(self, key: int, to_write: str) -> None:
+        """Write ``to_write`` once this line is completed"""
+        self.waiting.append(to_write)
+        if self.timer is not None:
+            return
+        # Do not count on the owner to write again
+        delay = self.since + _MAX_LINE_DELAY - time.monotonic()
+        self.timer = threading.Timer(delay, _end_stale_line, args=(key, self))
+        self.timer.daemon = True
+        self.timer.start()
+
+    def close(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+
+# id(fileobj) -> incomplete line at the end of the stream
+_OPEN_LINES: Dict[int, _OpenLine] = {}
+
+# Held while looking at or changing the two dicts above
+_LINES_LOCK = threading.RLock()
+
+# How long lines from other threads can wait for an incomplete
+# line to be completed, in seconds
+_MAX_LINE_DELAY = 0.5
+
+
+def buffering_enabled(fileobj: FileObj) -> bool:
+    # Buffering is opt-in: cli_ui cannot know when the stream is about
+    # to be used by a subprocess or by other code. Terminals are line
+    # buffered, so that dots and progress lines show up right away
+    if CONFIG["buffering"] != "always":
+        return False
+    return not _stream_capabilities(fileobj).isatty
+
+
+class _IdleFlusher:
+    """Flush pending writes once they are older than the flush interval,
+    even when no other message is written"""
+
+    def __init__(self) -> None:
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, name="cli_ui-flusher", daemon=True
+        )
+        self.thread.start()
+
+    def _run(self) -> None:
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            while True:
+                with _WRITE_LOCK:
+                    if not _PENDING:
+                        break
+                    oldest = min(pending.since for pending in _PENDING.values())
+                max_delay: Any = CONFIG["flush_interval"]
+                delay = oldest + max_delay - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                    continue
+                try:
+                    _flush_streams()
+                except (OSError, ValueError):
+                    # Stream closed in the meantime
+                    pass
+
+
+_IDLE_FLUSHER: Optional[_IdleFlusher] = None
+
+
+def _wake_idle_flusher() -> None:
+    global _IDLE_FLUSHER
+    # The thread does not survive a fork()
+    if _IDLE_FLUSHER is None or not _IDLE_FLUSHER.thread.is_alive():
+        _IDLE_FLUSHER = _IdleFlusher()
+    _IDLE_FLUSHER.wakeup.set()
+
+
+def _flush_streams(fileobj: Optional[FileObj] = None) -> None:
+    with _WRITE_LOCK:
+        if fileobj is None:
+            to_flush = list(_PENDING.values())
+            _PENDING.clear()
+        else:
+            pending = _PENDING.pop(id(fileobj), None)
+            to_flush = [pending] if pending else []
+        for pending in to_flush:
+            pending.fileobj.flush()
+        if _STATS is not None and to_flush:
+            _STATS.add_flushes(len(to_flush))
+
+
+def _write_and_flush(fileobj: FileObj, to_write: str) -> None:
+    with _WRITE_LOCK:
+        _write_and_flush_locked(fileobj, to_write)
+
+
+def _write_and_flush_locked(fileobj: FileObj, to_write: str) -> None:
+    if fileobj is sys.stderr and _PENDING:
+        # Keep messages in order when both streams end up in the same place
+        _flush_streams(sys.stdout)
+    stats = _STATS
+    if stats is not None:
+        start = time.perf_counter_ns()
+    fallback = False
+    capabilities = _stream_capabilities(fileobj)
+    if not capabilities.unicode and not to_write.isascii():
+        # The file descriptor does not support the full Unicode set,
+        # like stdout on Windows when it is redirected.
+        # Use the ASCII forms of the symbols, and the unidecode library
+        # for the other characters, while keeping as much info as we can
+        encodable = _encodable(to_write, capabilities.encoding)
+        fallback = encodable != to_write
+        to_write = encodable
     try:
         fileobj.write(to_write)
     except UnicodeEncodeError:
-        # Maybe the file descriptor does not support the full Unicode
-        # set, like stdout on Windows.
-        # Use the unidecode library
-        # to make sure we only have ascii, while still keeping
-        # as much info as we can
-        fileobj.write(unidecode.unidecode(to_write))
-    fileobj.flush()
+        # The stream does not use the encoding it advertises
+        to_write = _encodable(to_write, "ascii")
+        fileobj.write(to_write)
+        fallback = True
+    flushed = not buffering_enabled(fileobj)
+    if flushed:
+        fileobj.flush()
+    if stats is not None:
+        elapsed = time.perf_counter_ns() - start
+        stats.add_write(fileobj, to_write, elapsed, fallback=fallback, flushed=flushed)
+    if flushed:
+        return
+    pending = _PENDING.get(id(fileobj))
+    if pending is None:
+        pending = _PendingWrites(fileobj)
+        _PENDING[id(fileobj)] = pending
+        _wake_idle_flusher()
+    pending.size += len(to_write)
+    max_size: Any = CONFIG["buffer_size"]
+    max_delay: Any = CONFIG["flush_interval"]
+    if pending.size >= max_size or time.monotonic() - pending.since >= max_delay:
+        _flush_streams(fileobj)
+
+
+class _BackgroundWriter:
+    """Write messages from a dedicated thread.
+
+    Messages go through a single queue, so they are written
+    in the order they were emitted.
+    """
+
+    def __init__(self, maxsize: int, backpressure: str):
+        self.queue: "queue.Queue[Optional[Tuple[FileObj, str]]]" = queue.Queue(maxsize)
+        self.backpressure = backpressure
+        self.dropped = 0
+        self.thread = threading.Thread(
+            target=self._run, name="cli_ui-writer", daemon=True
+        )
+        self.thread.start()
+
+    def put(self, fileobj: FileObj, to_write: str) -> None:
+        item = (fileobj, to_write)
+        if self.backpressure == "block":
+            self.queue.put(item)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                if self.backpressure == "drop":
+                    self.dropped += 1
+                    return
+            # drop-oldest: make room and try again
+            try:
+                oldest = self.queue.get_nowait()
+            except queue.Empty:
+                continue
+            self.queue.task_done()
+            self.dropped += 1
+            if oldest is None:
+                # Never drop a request to stop the thread
+                self.queue.put(None)
+                return
+
+    def join(self) -> None:
+        """Wait until every queued message is written"""
+        self.queue.join()
+
+    def stop(self) -> None:
+        """Write every queued message, then stop the thread"""
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self) -> None:
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                _write_and_flush(*item)
+            except Exception:
+                sys.excepthook(*sys.exc_info())
+            finally:
+                self.queue.task_done()
+
+
+_BACKGROUND_WRITER: Optional[_BackgroundWriter] = None
+_BACKGROUND_WRITER_LOCK = threading.Lock()
+_DROPPED_MESSAGES = 0
+
+
+def _get_background_writer() -> _BackgroundWriter:
+    global _BACKGROUND_WRITER
+    with _BACKGROUND_WRITER_LOCK:
+        if _BACKGROUND_WRITER is None:
+            maxsize: Any = CONFIG["queue_size"]
+            backpressure: Any = CONFIG["backpressure"]
+            _BACKGROUND_WRITER = _BackgroundWriter(maxsize, backpressure)
+        return _BACKGROUND_WRITER
+
+
+def _stop_background_writer() -> None:
+    global _BACKGROUND_WRITER, _DROPPED_MESSAGES
+    with _BACKGROUND_WRITER_LOCK:
+        writer, _BACKGROUND_WRITER = _BACKGROUND_WRITER, None
+    if writer:
+        writer.stop()
+        _DROPPED_MESSAGES += writer.dropped
+
+
+def dropped_messages() -> int:
+    """Number of messages discarded because the queue of the
+    background writer was full. See :func:`setup`.
+    """
+    writer = _BACKGROUND_WRITER
+    return _DROPPED_MESSAGES + (writer.dropped if writer else 0)
+
+
+def flush(fileobj: Optional[FileObj] = None) -> None:
+    """Flush messages kept in stream buffers.
+
+    When writing from a background thread, wait for
+    queued messages to be written first.
+
+    :param fileobj: only flush this stream. By default, flush every stream
+                    that has pending messages.
+    """
+    _commit_partial_lines(threading.get_ident())
+    writer = _BACKGROUND_WRITER
+    if writer:
+        writer.join()
+    _flush_streams(fileobj)
+
+
+def _flush_at_exit() -> None:
+    try:
+        _commit_partial_lines()
+        _stop_background_writer()
+        flush()
+    except (OSError, ValueError):
+        # Stream already closed, nothing we can do
+        pass
+
+
+atexit.register(_flush_at_exit)
+
+
+# Set in worker processes, see cli_ui.mp
+_FORWARDER: Any = None
+
+
+def write_and_flush(fileobj: FileObj, to_write: str) -> None:
+    if _FORWARDER is not None and _FORWARDER.write(fileobj, to_write):
+        return
+    if CONFIG["background"]:
+        _get_background_writer().put(fileobj, to_write)
+    else:
+        _write_and_flush(fileobj, to_write)
+
+
+def _emit(fileobj: FileObj, to_write: str, *, complete: bool) -> None:
+    """Write a message, without mixing it with lines from other threads.
+
+    Incomplete lines are written right away, unless another thread has an
+    incomplete line on the same stream. In that case, the beginning of the
+    line is kept aside and written along with the message that completes
+    it, and complete lines wait for the other line to be completed - for
+    _MAX_LINE_DELAY seconds at most.
+    """
+    ident = threading.get_ident()
+    key = id(fileobj)
+    with _LINES_LOCK:
+        lines = _PARTIAL_LINES.get(ident)
+        held = lines.pop(key, None) if lines else None
+        if held:
+            to_write = "".join(held[1]) + to_write
+        line = _OPEN_LINES.get(key)
+        if line is not None and line.fileobj is not fileobj:
+            # Left by a stream which no longer exists
+            line.close()
+            line = None
+            del _OPEN_LINES[key]
+        if line is None:
+            if not complete:
+                _OPEN_LINES[key] = _OpenLine(ident, fileobj)
+            write_and_flush(fileobj, to_write)
+            return
+        late = time.monotonic() - line.since >= _MAX_LINE_DELAY
+        if line.owner == ident:
+            if complete:
+                line.close()
+                del _OPEN_LINES[key]
+                to_write += "".join(line.waiting)
+            elif line.waiting and late:
+                # Let the other threads through, and go on on a new line
+                line.close()
+                to_write = "\n" + "".join(line.waiting) + to_write
+                _OPEN_LINES[key] = _OpenLine(ident, fileobj)
+            write_and_flush(fileobj, to_write)
+            return
+        if not complete:
+            _PARTIAL_LINES.setdefault(ident, {})[key] = (fileobj, [to_write])
+            return
+        if not late:
+            line.wait(key, to_write)
+            return
+        # The other line takes too long to be completed: end it
+        line.close()
+        del _OPEN_LINES[key]
+        write_and_flush(fileobj, "\n" + "".join(line.waiting) + to_write)
+
+
+def _end_stale_line(key: int, line: _OpenLine) -> None:
+    # Called by the timer of a line whose owner did not write in time
+    with _LINES_LOCK:
+        if _OPEN_LINES.get(key) is not line or not line.waiting:
+            return
+        del _OPEN_LINES[key]
+        write_and_flush(line.fileobj, "\n" + "".join(line.waiting))
+
+
+def _commit_partial_lines(ident: Optional[int] = None) -> None:
+    """Write incomplete lines kept aside by :func:`_emit`, for the given
+    thread or for every thread"""
+    with _LINES_LOCK:
+        idents = list(_PARTIAL_LINES) if ident is None else [ident]
+        for owner in idents:
+            lines = _PARTIAL_LINES.pop(owner, None)
+            if not lines:
+                continue
+            for key, (fileobj, parts) in lines.items():
+                to_write = "".join(parts)
+                line = _OPEN_LINES.get(key)
+                if line is not None:
+                    line.close()
+                    to_write = "\n" + "".join(line.waiting) + to_write
+                _OPEN_LINES[key] = _OpenLine(owner, fileobj)
+                write_and_flush(fileobj, to_write)
+        if ident is None:
+            # Exiting: write the lines still waiting
+            for line in _OPEN_LINES.values():
+                line.close()
+                if line.waiting:
+                    write_and_flush(line.fileobj, "\n" + "".join(line.waiting))
+            _OPEN_LINES.clear()
+
+
+class Record(NamedTuple):
+    """A message kept by a :class:`Recorder`"""
+
+    text: str
+    level: str
+    stream: str
+
+
+_REGEX_SPECIAL_CHARS = re.compile(r"[.^$*+?{}\[\]\\|()]")
+
+
+def _is_literal(pattern: str) -> bool:
+    return _REGEX_SPECIAL_CHARS.search(pattern) is None
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_query(pattern: str) -> Callable[[str], bool]:
+    # Plain strings are looked up with the 'in' operator, which is
+    # much faster than re.search()
+    if _is_literal(pattern):
+        return lambda text: pattern in text
+    regexp = re.compile(pattern)
+    return lambda text: regexp.search(text) is not None
+
+
+class Recorder:
+    """Record the messages emitted while recording is on.
+
+    :param capacity: maximum number of messages to keep in memory.
+                     When this is reached, the oldest messages are dropped,
+                     or moved to ``spill_path`` if it is set.
+                     Defaults to no limit.
+    :param spill_path: path of a file in which to write the messages that do
+                       not fit in memory, one JSON object per line.
+                       They are still taken into account by the queries.
+
+    Queries take a regular expression pattern, and can be restricted to
+    a level (``"error"``, ``"warning"``, ``"info"``) or a stream
+    (``"stdout"``, ``"stderr"``, or the name of the file object).
+    """
+
+    def __init__(
+        self, *, capacity: Optional[int] = None, spill_path: Optional[str] = None
+    ):
+        self.capacity = capacity
+        self.spill_path = spill_path
+        self.spilled = 0
+        self._records: Deque[Record] = collections.deque()
+        self._spill_lock = threading.Lock()
+
+    def start(self) -> None:
+        """Start recording messages"""
+        global _RECORDER
+        _RECORDER = self
+        CONFIG["record"] = True
+
+    def stop(self) -> None:
+        """Stop recording messages"""
+        global _RECORDER
+        CONFIG["record"] = False
+        if _RECORDER is self:
+            _RECORDER = None
+
+    def reset(self) -> None:
+        """Forget about the recorded messages"""
+        self._records.clear()
+        with self._spill_lock:
+            if self.spilled and self.spill_path:
+                os.remove(self.spill_path)
+            self.spilled = 0
+
+    def record(self, text: str, *, level: str = "info", stream: str = "stdout") -> None:
+        """Add a message to the recorded ones"""
+        records = self._records
+        if self.capacity is not None and len(records) >= self.capacity:
+            oldest = records.popleft()
+            if self.spill_path:
+                self._spill(self.spill_path, oldest)
+        records.append(Record(text, level, stream))
+
+    def _spill(self, path: str, record: Record) -> None:
+        import json
+
+        with self._spill_lock:
+            # Start from an empty file, not from a previous run
+            mode = "a" if self.spilled else "w"
+            with open(path, mode, encoding="utf-8") as fp:
+                fp.write(json.dumps(record._asdict()) + "\n")
+            self.spilled += 1
+
+    def records(
+        self, *, level: Optional[str] = None, stream: Optional[str] = None
+    ) -> Iterator[Record]:
+        """Iterate over the recorded messages, oldest first"""
+        return self._records_matching(level, stream, None)
+
+    def _records_matching(
+        self, level: Optional[str], stream: Optional[str], needle: Optional[str]
+    ) -> Iterator[Record]:
+        # needle: a string that the text of the records must contain
+        for record in itertools.chain(
+            self._spilled_records(level, stream, needle), list(self._records)
+        ):
+            if level is not None and record.level != level:
+                continue
+            if stream is not None and record.stream != stream:
+                continue
+            yield record
+
+    def _spilled_records(
+        self, level: Optional[str], stream: Optional[str], needle: Optional[str]
+    ) -> Iterator[Record]:
+        # Lines are read one at a time, and only the ones that may match
+        # are parsed, so that queries do not load the whole history
+        count = self.spilled
+        if not count or not self.spill_path:
+            return
+        import json
+
+        # Substrings of the JSON lines, see _spill()
+        needles = []
+        if needle:
+            needles.append(json.dumps(needle)[1:-1])
+        if level is not None:
+            needles.append('"level": %s' % json.dumps(level))
+        if stream is not None:
+            needles.append('"stream": %s' % json.dumps(stream))
+        with open(self.spill_path, encoding="utf-8") as fp:
+            # Lines are written in one piece, and only the first ones are
+            # part of this query
+            for line in itertools.islice(fp, count):
+                if all(part in line for part in needles):
+                    yield Record(**json.loads(line))
+
+    def _matching(
+        self, pattern: str, level: Optional[str], stream: Optional[str]
+    ) -> Iterator[str]:
+        matches = _compile_query(pattern)
+        needle = pattern if _is_literal(pattern) else None
+        for record in self._records_matching(level, stream, needle):
+            if matches(record.text):
+                yield record.text
+
+    def find(
+        self,
+        pattern: str,
+        *,
+        level: Optional[str] = None,
+        stream: Optional[str] = None,
+    ) -> Optional[str]:
+        """Find a message in the list of recorded messages
+
+        :param pattern: regular expression pattern to use
+                        when looking for recorded message
+        :return: the first matching message, or None
+        """
+        return next(self._matching(pattern, level, stream), None)
+
+    def find_all(
+        self,
+        pattern: str,
+        *,
+        level: Optional[str] = None,
+        stream: Optional[str] = None,
+    ) -> List[str]:
+        """Return all the recorded messages matching the pattern"""
+        return list(self._matching(pattern, level, stream))
+
+    def count(
+        self,
+        pattern: str = "",
+        *,
+        level: Optional[str] = None,
+        stream: Optional[str] = None,
+    ) -> int:
+        """Return the number of recorded messages matching the pattern"""
+        return sum(1 for _ in self._matching(pattern, level, stream))
+
+    def __len__(self) -> int:
+        return self.spilled + len(self._records)
+
+
+_RECORDER: Optional[Recorder] = None
+
+
+def _get_recorder() -> Recorder:
+    # When CONFIG["record"] is set directly, record in a default recorder
+    global _RECORDER
+    if _RECORDER is None:
+        _RECORDER = Recorder()
+    return _RECORDER
+
+
+def _stream_name(fileobj: FileObj) -> str:
+    if fileobj is sys.stdout:
+        return "stdout"
+    if fileobj is sys.stderr:
+        return "stderr"
+    return str(getattr(fileobj, "name", type(fileobj).__name__))
+
+
+def _level_of(tokens: Sequence[Token]) -> str:
+    if tokens and isinstance(tokens[0], Template):
+        return _TEMPLATE_LEVELS.get(tokens[0], "info")
+    return "info"
+
+
+# Upper bounds of the buckets of the latency histograms, in nanoseconds
+_LATENCY_BOUNDS = (
+    1_000,
+    2_000,
+    5_000,
+    10_000,
+    20_000,
+    50_000,
+    100_000,
+    200_000,
+    500_000,
+    1_000_000,
+    10_000_000,
+    100_000_000,
+    1_000_000_000,
+)
+
+
+class _Histogram:
+    """Distribution of durations, in nanoseconds"""
+
+    def __init__(self) -> None:
+        # The last bucket is for durations above every bound
+        self.counts = [0] * (len(_LATENCY_BOUNDS) + 1)
+        self.total = 0
+        self.max = 0
+
+    def add(self, duration: int) -> None:
+        self.counts[bisect.bisect_left(_LATENCY_BOUNDS, duration)] += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def as_dict(self) -> Dict[str, Any]:
+        count = sum(self.counts)
+        bounds: List[Optional[float]] = [bound / 1e9 for bound in _LATENCY_BOUNDS]
+        bounds.append(None)
+        return {
+            "count": count,
+            "total": self.total / 1e9,
+            "mean": self.total / count / 1e9 if count else 0.0,
+            "max": self.max / 1e9,
+            "buckets": [list(bucket) for bucket in zip(bounds, self.counts)],
+        }
+
+
+class _Stats:
+    """Counters updated on the write path when stats are enabled,
+    see :func:`stats`"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.messages = dict.fromkeys(("debug", "info", "warning", "error"), 0)
+        self.bytes: Dict[str, int] = {}
+        self.flushes = 0
+        self.unicode_fallbacks = 0
+        self.render_time = _Histogram()
+        self.write_time = _Histogram()
+
+    def add_message(self, level: str, duration: int) -> None:
+        with self.lock:
+            self.messages[level] = self.messages.get(level, 0) + 1
+            self.render_time.add(duration)
+
+    def add_write(
+        self,
+        fileobj: FileObj,
+        to_write: Union[str, bytes],
+        duration: int,
+        *,
+        fallback: bool,
+        flushed: bool,
+    ) -> None:
+        stream = _stream_name(fileobj)
+        if isinstance(to_write, bytes) or to_write.isascii():
+            size = len(to_write)
+        else:
+            encoding = _stream_capabilities(fileobj).encoding
+            try:
+                size = len(to_write.encode(encoding, "replace"))
+            except LookupError:
+                size = len(to_write.encode("utf-8"))
+        with self.lock:
+            self.bytes[stream] = self.bytes.get(stream, 0) + size
+            self.flushes += flushed
+            self.unicode_fallbacks += fallback
+            self.write_time.add(duration)
+
+    def add_flushes(self, count: int) -> None:
+        with self.lock:
+            self.flushes += count
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "messages": dict(self.messages),
+                "bytes": dict(self.bytes),
+                "flushes": self.flushes,
+                "unicode_fallbacks": self.unicode_fallbacks,
+                "render_time": self.render_time.as_dict(),
+                "write_time": self.write_time.as_dict(),
+            }
+
+
+# Set by setup(stats=True). The write path only looks at this variable
+# when stats are disabled.
+_STATS: Optional[_Stats] = None
+
+
+def stats(*, reset: bool = False) -> Optional[Dict[str, Any]]:
+    """Return statistics collected since stats were enabled with
+    ``setup(stats=True)``, or None if they are disabled.
+
+    The result contains:
+
+    * ``messages``: number of messages per level
+    * ``bytes``: number of bytes written per stream, in the stream's encoding
+    * ``flushes``: number of times a stream was flushed
+    * ``unicode_fallbacks``: number of writes that had to be converted
+      to ASCII because the stream could not encode them
+    * ``render_time`` and ``write_time``: histograms of the time spent
+      rendering messages and writing them to streams. Times are in
+      seconds, and ``buckets`` is a list of ``[upper bound, count]``
+      pairs. The last bound is None.
+
+    :param reset: Start counting from zero again afterwards
+    """
+    global _STATS
+    current = _STATS
+    if current is None:
+        return None
+    if reset:
+        _STATS = _Stats()
+    return current.as_dict()
 
 
 def message(
@@ -243,16 +1424,152 @@ def message(
     sep: str = " ",
     fileobj: FileObj = sys.stdout,
     update_title: bool = False,
+    fields: Optional[Dict[str, Any]] = None,
 ) -> None:
     """Helper method for error, warning, info, debug"""
+    stats = _STATS
+    if stats is not None:
+        start = time.perf_counter_ns()
+    to_write: Optional[str]
+    if CONFIG["format"] == "jsonl":
+        to_write = _jsonl_line(tokens, end, sep, fileobj, fields, threading.get_ident())
+        complete = True
+    elif _FORWARDER is not None and _FORWARDER.message(tokens, end, sep, fileobj):
+        return
+    else:
+        to_write = _message_string(tokens, end, sep, fileobj, update_title)
+        complete = "\n" in end or "\r" in end
+    if stats is not None:
+        stats.add_message(_level_of(tokens), time.perf_counter_ns() - start)
+    if to_write is not None:
+        _emit(fileobj, to_write, complete=complete)
+
+
+# (second, formatted date) - see _jsonl_time()
+_JSONL_TIME_CACHE: Tuple[int, str] = (-1, "")
+
+# (owner, id(fileobj)) -> beginning of the current record, where owner
+# is the current thread or asyncio task
+_JSONL_PARTIAL: Dict[Tuple[int, int], List[str]] = {}
+
+
+def _jsonl_time() -> str:
+    # ISO 8601, in UTC
+    global _JSONL_TIME_CACHE
+    now = time.time()
+    second = int(now)
+    cached_second, res = _JSONL_TIME_CACHE
+    if second != cached_second:
+        res = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second))
+        _JSONL_TIME_CACHE = (second, res)
+    return "%s.%03dZ" % (res, (now - second) * 1000)
+
+
+def _jsonl_record(
+    level: str, stream: str, text: str, extra: Optional[Dict[str, Any]] = None
+) -> str:
+    """Serialize one record, as a single line"""
+    # Only the strings need escaping. The C function behind
+    # json.dumps(..., ensure_ascii=False) does it without the
+    # overhead of creating an encoder for each call
+    from json.encoder import encode_basestring
+
+    res = '{"time": "%s", "level": "%s", "stream": %s, "message": %s' % (
+        _jsonl_time(),
+        level,
+        encode_basestring(stream),
+        encode_basestring(text),
+    )
+    if extra:
+        import json
+
+        res += ", " + json.dumps(extra, ensure_ascii=False, default=str)[1:-1]
+    return res + "}\n"
+
+
+def _plain_text(tokens: Sequence[Token], sep: str) -> str:
+    return sep.join(
+        str(token) for token in _flatten_tokens(tokens) if not isinstance(token, Color)
+    )
+
+
+def _jsonl_line(
+    tokens: Sequence[Token],
+    end: str,
+    sep: str,
+    fileobj: FileObj,
+    fields: Optional[Dict[str, Any]],
+    owner: int,
+) -> Optional[str]:
+    """Return the record for a message, or None if the message does
+    not end a line, in which case it is kept until it is completed.
+    """
+    level = _level_of(tokens)
+    stream = _stream_name(fileobj)
+    if CONFIG["record"]:
+        rendered = RenderedTokens(tokens, end=end, sep=sep)
+        _get_recorder().record(rendered.without_color, level=level, stream=stream)
+    if tokens and isinstance(tokens[0], Template):
+        # The level is already in the record
+        tokens = tokens[1:]
+    text = _plain_text(tokens, sep)
+    key = (owner, id(fileobj))
+    if not ("\n" in end or "\r" in end):
+        _JSONL_PARTIAL.setdefault(key, []).append(text + end)
+        return None
+    held = _JSONL_PARTIAL.pop(key, None)
+    if held:
+        text = "".join(held) + text
+    return _jsonl_record(level, stream, text, {"fields": fields} if fields else None)
+
+
+def _jsonl_rows(
+    rows: Iterable[Sequence[Sequence[Token]]],
+    headers: Union[str, Sequence[str]],
+    stream: str,
+) -> Iterator[str]:
+    """Yield records for the rows of a table, by batches"""
+    if headers == "keys":
+        # Columns are given as a dict
+        columns: Any = rows
+        keys = [_plain_text(key, " ") for key in columns.keys()]
+        rows = zip(*columns.values())
+    elif headers == "firstrow":
+        rows = iter(rows)
+        keys = [_plain_text(cell, " ") for cell in next(rows, [])]
+    else:
+        keys = list(headers)
+    rows = iter(rows)
+    while True:
+        batch = []
+        for row in itertools.islice(rows, 1000):
+            cells = [_plain_text(cell, " ") for cell in row]
+            extra = {"row": dict(zip(keys, cells)) if keys else cells}
+            batch.append(_jsonl_record("info", stream, " ".join(cells), extra))
+        if not batch:
+            return
+        yield "".join(batch)
+
+
+def _message_string(
+    tokens: Sequence[Token],
+    end: str,
+    sep: str,
+    fileobj: FileObj,
+    update_title: bool,
+) -> str:
     should_use_colors = colors_enabled(fileobj)
-    with_color, without_color = process_tokens(tokens, end=end, sep=sep)
+    rendered = RenderedTokens(tokens, end=end, sep=sep)
     if CONFIG["record"]:
-        _MESSAGES.append(without_color)
-    if update_title and with_color:
-        write_title_string(without_color, fileobj)
-    to_write = with_color if should_use_colors else without_color
-    write_and_flush(fileobj, to_write)
+        _get_recorder().record(
+            rendered.without_color,
+            level=_level_of(tokens),
+            stream=_stream_name(fileobj),
+        )
+    to_write = rendered.get(should_use_colors)
+    if update_title and title_enabled(fileobj):
+        to_write = _title_string(rendered.without_color) + to_write
+    return to_write
 
 
 def fatal(*tokens: Token, exit_code: int = 1, **kwargs: Any) -> None:
@@ -262,22 +1579,143 @@ def fatal(*tokens: Token, exit_code: int = 1, **kwargs: Any) -> None:
                    ``(cli_ui.red, "this is a fatal  error")``
     :param exit_code: value of the exit code (default: 1)
     """
-    error(*tokens, **kwargs)
+    # Not subject to flood control
+    kwargs["fileobj"] = sys.stderr
+    message(_ERROR_TEMPLATE, *tokens, **kwargs)
+    flush()
     sys.exit(exit_code)
 
 
+_ERROR_TEMPLATE = Template(bold, red, "Error:")
+_WARNING_TEMPLATE = Template(brown, "Warning:")
+_INFO_1_TEMPLATE = Template(bold, blue, "::", reset)
+_INFO_2_TEMPLATE = Template(bold, blue, "=>", reset)
+_INFO_3_TEMPLATE = Template(bold, blue, "*", reset)
+
+# Renders as nothing, only there to tell debug messages apart
+_DEBUG_TEMPLATE = Template()
+
+_TEMPLATE_LEVELS = {
+    _ERROR_TEMPLATE: "error",
+    _WARNING_TEMPLATE: "warning",
+    _DEBUG_TEMPLATE: "debug",
+}
+
+
 def error(*tokens: Token, **kwargs: Any) -> None:
     """Print an error message"""
-    args = [bold, red, "Error:"] + list(tokens)
+    if CONFIG["error_limit"] is not None:
+        if not _FLOOD_CONTROL.allow("error", sys._getframe(1)):
+            return
     kwargs["fileobj"] = sys.stderr
-    message(*args, **kwargs)
+    message(_ERROR_TEMPLATE, *tokens, **kwargs)
 
 
 def warning(*tokens: Token, **kwargs: Any) -> None:
     """Print a warning message"""
-    args = [brown, "Warning:"] + list(tokens)
+    if CONFIG["warning_limit"] is not None:
+        if not _FLOOD_CONTROL.allow("warning", sys._getframe(1)):
+            return
     kwargs["fileobj"] = sys.stderr
-    message(*args, **kwargs)
+    message(_WARNING_TEMPLATE, *tokens, **kwargs)
+
+
+class _FloodSite:
+    """Messages of one level sent from one line of code"""
+
+    def __init__(self, since: float):
+        self.since = since
+        # In the current window
+        self.count = 0
+        self.suppressed = 0
+
+
+class _FloodControl:
+    """Suppress warnings and errors repeated too often, see :func:`setup`"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # (level, filename, line) -> site
+        self.sites: Dict[Tuple[str, str, int], _FloodSite] = {}
+        self.total_suppressed = 0
+
+    def allow(self, level: str, frame: Any) -> bool:
+        """Whether a message sent from the given frame should be displayed"""
+        key = (level, frame.f_code.co_filename, frame.f_lineno)
+        limit: Any = CONFIG[level + "_limit"]
+        window: Any = CONFIG["flood_window"]
+        now = time.monotonic()
+        with self.lock:
+            site = self.sites.get(key)
+            if site is None:
+                site = _FloodSite(now)
+                self.sites[key] = site
+            suppressed = 0
+            if now - site.since >= window:
+                suppressed = site.suppressed
+                site.since = now
+                site.count = 0
+                site.suppressed = 0
+            site.count += 1
+            allowed: bool = site.count <= limit
+            if not allowed:
+                site.suppressed += 1
+                self.total_suppressed += 1
+        if suppressed:
+            _info_suppressed(key, suppressed)
+        return allowed
+
+    def report(self) -> None:
+        """Display how many messages were suppressed in the current
+        windows, and start over"""
+        with self.lock:
+            sites = [
+                (key, site.suppressed)
+                for key, site in self.sites.items()
+                if site.suppressed
+            ]
+            self.sites.clear()
+        for key, suppressed in sites:
+            _info_suppressed(key, suppressed)
+
+
+def _info_suppressed(key: Tuple[str, str, int], suppressed: int) -> None:
+    level, filename, line = key
+    template = _ERROR_TEMPLATE if level == "error" else _WARNING_TEMPLATE
+    message(
+        template,
+        "suppressed {:,} similar {}{} from {}:{}".format(
+            suppressed,
+            level,
+            "s" if suppressed > 1 else "",
+            os.path.basename(filename),
+            line,
+        ),
+        fileobj=sys.stderr,
+        fields={"suppressed": suppressed, "file": filename, "line": line},
+    )
+
+
+_FLOOD_CONTROL = _FloodControl()
+
+
+def suppressed_messages() -> int:
+    """Number of warnings and errors suppressed because they were repeated
+    too often. See :func:`setup`.
+    """
+    return _FLOOD_CONTROL.total_suppressed
+
+
+def _report_suppressed_at_exit() -> None:
+    try:
+        _FLOOD_CONTROL.report()
+    except (OSError, ValueError):
+        # Stream already closed, nothing we can do
+        pass
+
+
+# Registered after _flush_at_exit(), so that it runs before it
+atexit.register(_report_suppressed_at_exit)
 
 
 def info(*tokens: Token, **kwargs: Any) -> None:
@@ -288,6 +1726,7 @@ def info(*tokens: Token, **kwargs: Any) -> None:
     :param end: token to place at the end, defaults to ``'\n'``
     :param fileobj: file-like object to print the output, defaults to ``sys.stdout``
     :param update_title: whether to update the title of the terminal window
+    :param fields: extra values for the record, when the format is 'jsonl'
     """
     if CONFIG["quiet"]:
         return
@@ -296,27 +1735,41 @@ def info(*tokens: Token, **kwargs: Any) -> None:
 
 def info_section(*tokens: Token, **kwargs: Any) -> None:
     """Print an underlined section name"""
-    # We need to know the length of the section:
-    process_tokens_kwargs = kwargs.copy()
-    process_tokens_kwargs["color"] = False
-    no_color = _process_tokens(tokens, **process_tokens_kwargs)
+    if CONFIG["quiet"]:
+        return
+    if CONFIG["format"] == "jsonl":
+        message(*tokens, **kwargs)
+        return
+    # We need to know the length of the section. Other arguments, such
+    # as fields, only matter to message()
+    process_tokens_kwargs = {
+        key: value for key, value in kwargs.items() if key in ("sep", "end")
+    }
+    no_color = _process_tokens(tokens, color=False, **process_tokens_kwargs)
     info(*tokens, **kwargs)
-    info("-" * len(no_color), end="\n\n")
+    underline_kwargs = {key: value for key, value in kwargs.items() if key == "fileobj"}
+    info("-" * len(no_color), end="\n\n", **underline_kwargs)
 
 
 def info_1(*tokens: Token, **kwargs: Any) -> None:
     """Print an important informative message"""
-    info(bold, blue, "::", reset, *tokens, **kwargs)
+    if CONFIG["quiet"]:
+        return
+    message(_INFO_1_TEMPLATE, *tokens, **kwargs)
 
 
 def info_2(*tokens: Token, **kwargs: Any) -> None:
     """Print an not so important informative message"""
-    info(bold, blue, "=>", reset, *tokens, **kwargs)
+    if CONFIG["quiet"]:
+        return
+    message(_INFO_2_TEMPLATE, *tokens, **kwargs)
 
 
 def info_3(*tokens: Token, **kwargs: Any) -> None:
     """Print an even less important informative message"""
-    info(bold, blue, "*", reset, *tokens, **kwargs)
+    if CONFIG["quiet"]:
+        return
+    message(_INFO_3_TEMPLATE, *tokens, **kwargs)
 
 
 def dot(*, last: bool = False, fileobj: FileObj = sys.stdout) -> None:
@@ -331,9 +1784,19 @@ def dot(*, last: bool = False, fileobj: FileObj = sys.stdout) -> None:
     info(".", end=end, fileobj=fileobj)
 
 
-def erase_last_line() -> None:
-    terminal_size = shutil.get_terminal_size()
-    info(" " * terminal_size.columns, end="\r")
+def erase_last_line(fileobj: FileObj = sys.stdout) -> None:
+    """Erase the current line and move the cursor back to its start.
+
+    On terminals, this uses an escape sequence. Otherwise, the line
+    is overwritten with spaces.
+    """
+    if CONFIG["quiet"] or CONFIG["format"] == "jsonl":
+        return
+    capabilities = _stream_capabilities(fileobj)
+    if capabilities.isatty and os.name != "nt":
+        _emit(fileobj, "\r\x1b[K", complete=True)
+    else:
+        _emit(fileobj, " " * capabilities.columns + "\r", complete=True)
 
 
 def info_count(
@@ -349,28 +1812,371 @@ def info_count(
     :param n: total number of items
     :param one_line: force all messages to be printed on one line
     """
+    if CONFIG["quiet"]:
+        return
     num_digits = len(str(n))
     counter_format = "(%{}d/%d)".format(num_digits)
     counter_str = counter_format % (i + 1, n)
     if one_line:
         kwargs["end"] = "\r"
-        erase_last_line()
+        erase_last_line(kwargs["fileobj"] if "fileobj" in kwargs else sys.stdout)
     info(green, "*", reset, counter_str, reset, *rest, **kwargs)
 
 
+# Last line written by info_progress(), so that it is not written again
+_LAST_PROGRESS: Optional[str] = None
+
+
 def info_progress(prefix: str, value: float, max_value: float) -> None:
     """Display info progress in percent.
 
+    Nothing is written if the line would be the same as the last one.
+    See :class:`Progress` for a more complete progress display.
+
     :param value: the current value
     :param max_value: the max value
     :param prefix: the prefix message to print
 
 
     """
+    global _LAST_PROGRESS
     if colors_enabled(sys.stdout):
         percent = float(value) / max_value * 100
         to_write = prefix + ": %.0f%%\r" % percent
-        write_and_flush(sys.stdout, to_write)
+        if to_write == _LAST_PROGRESS:
+            return
+        _LAST_PROGRESS = to_write
+        _emit(sys.stdout, to_write, complete=True)
+
+
+def _format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+
+class Progress:
+    """Display the progress of a long task on a single line, with
+    throughput and estimated time left.
+
+    Calling :meth:`update` is cheap: the clock is only looked at every
+    few items, the line is redrawn at most every ``min_interval`` seconds,
+    and only if it changed. A background thread makes sure the next item
+    is not drawn late when items start coming in slower. Like
+    :func:`info_progress`, nothing is drawn unless the output is a terminal.
+
+    ::
+
+        >>> with cli_ui.Progress("Copying", total=len(files)) as progress:
+        ...     for file in files:
+        ...         copy(file)
+        ...         progress.update()
+
+    :param description: printed before the counter
+    :param total: number of items, if known
+    :param min_interval: minimum number of seconds between two redraws
+    :param smoothing: weight of the latest measure in the moving average
+                      used to compute the throughput, between 0 and 1
+    """
+
+    def __init__(
+        self,
+        description: str,
+        total: Optional[int] = None,
+        *,
+        min_interval: float = 0.1,
+        smoothing: float = 0.3,
+        fileobj: FileObj = sys.stdout,
+    ):
+        self.description = description
+        self.total = total
+        self.min_interval = min_interval
+        self.smoothing = smoothing
+        self.fileobj = fileobj
+        self.count = 0
+        self.rate: Optional[float] = None
+        self.enabled = colors_enabled(fileobj)
+        self.start_time = time.monotonic()
+        self._last_time = self.start_time
+        self._last_count = 0
+        self._last_line: Optional[str] = None
+        self._clocked = False
+        # Look at the clock once self.count reaches this value
+        self.next_check = 1
+
+    def __enter__(self) -> "Progress":
+        return self
+
+    def __exit__(self, *unused: Any) -> None:
+        self.close()
+
+    def update(self, n: int = 1) -> None:
+        """Record that ``n`` more items were processed"""
+        self.count += n
+        if self.count >= self.next_check:
+            self.check()
+
+    def check(self) -> None:
+        """Redraw the line if enough time has passed"""
+        now = time.monotonic()
+        if now - self._last_time < self.min_interval:
+            # Checked too early, wait for a few more items next time
+            self.next_check = self.count + max(self.count - self._last_count, 1)
+            return
+        self.measure(now)
+        # Next check roughly when min_interval has elapsed again. If items
+        # start coming in slower, the progress clock brings it forward
+        rate = self.rate or 0
+        self.next_check = self.count + max(int(rate * self.min_interval), 1)
+        if self.enabled and not self._clocked:
+            _PROGRESS_CLOCK.add(self)
+            self._clocked = True
+        self.draw()
+
+    def measure(self, now: float) -> None:
+        """Update the throughput with the items processed since last time"""
+        elapsed = now - self._last_time
+        if elapsed <= 0:
+            return
+        instant_rate = (self.count - self._last_count) / elapsed
+        if self.rate is None:
+            self.rate = instant_rate
+        else:
+            self.rate += self.smoothing * (instant_rate - self.rate)
+        self._last_time = now
+        self._last_count = self.count
+
+    def line(self) -> str:
+        """The text to display, without the final carriage return"""
+        res = "%s: " % self.description if self.description else ""
+        if self.total:
+            percent = self.count / self.total * 100
+            res += "%3.0f%% (%d/%d)" % (percent, self.count, self.total)
+        else:
+            res += str(self.count)
+        if self.rate:
+            res += " %.1f/s" % self.rate
+            if self.total:
+                eta = max(self.total - self.count, 0) / self.rate
+                res += " ETA %s" % _format_duration(eta)
+        return res
+
+    def draw(self) -> None:
+        if not self.enabled:
+            return
+        line = self.line()
+        if line == self._last_line:
+            return
+        # Pad with spaces to hide what is left of a longer line
+        padding = " " * max(len(self._last_line or "") - len(line), 0)
+        self._last_line = line
+        _emit(self.fileobj, line + padding + "\r", complete=True)
+
+    def close(self) -> None:
+        """Draw the final state and go to the next line"""
+        if self._clocked:
+            _PROGRESS_CLOCK.discard(self)
+            self._clocked = False
+        if not self.enabled:
+            return
+        elapsed = time.monotonic() - self.start_time
+        if elapsed > 0:
+            self.rate = self.count / elapsed
+        self.draw()
+        if self._last_line is not None:
+            _emit(self.fileobj, "\n", complete=True)
+
+
+class _ProgressClock:
+    """Make displayed :class:`Progress` instances look at the clock at
+    least every ``min_interval``, even when items start coming in much
+    slower than the rate used to plan the next check"""
+
+    def __init__(self) -> None:
+        self.progresses: "weakref.WeakSet[Progress]" = weakref.WeakSet()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def add(self, progress: Progress) -> None:
+        with self.lock:
+            self.progresses.add(progress)
+            # The thread does not survive a fork()
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self._run, name="cli_ui-progress-clock", daemon=True
+                )
+                self.thread.start()
+            self.wakeup.set()
+
+    def discard(self, progress: Progress) -> None:
+        with self.lock:
+            self.progresses.discard(progress)
+
+    def _run(self) -> None:
+        while True:
+            self.wakeup.wait()
+            with self.lock:
+                progresses = list(self.progresses)
+                if not progresses:
+                    self.wakeup.clear()
+                    continue
+            now = time.monotonic()
+            for progress in progresses:
+                if now - progress._last_time >= progress.min_interval:
+                    # Check on the next update()
+                    progress.next_check = 0
+            interval = min(progress.min_interval for progress in progresses)
+            del progresses
+            time.sleep(interval)
+
+
+_PROGRESS_CLOCK = _ProgressClock()
+
+
+class ProgressGroup:
+    """Display the progress of several concurrent tasks, one line per task.
+
+    Tasks only increment their counter, which is cheap and can be done from
+    any thread or asyncio task. A single thread redraws every line ``fps``
+    times per second. Avoid printing other messages while the group is
+    displayed.
+
+    ::
+
+        >>> with cli_ui.ProgressGroup() as group:
+        ...     def download(url):
+        ...         progress = group.add(url, total=size(url))
+        ...         for chunk in fetch(url):
+        ...             progress.update(len(chunk))
+        ...     with ThreadPoolExecutor() as executor:
+        ...         executor.map(download, urls)
+    """
+
+    def __init__(self, *, fps: float = 10, fileobj: FileObj = sys.stdout):
+        self.fileobj = fileobj
+        self.interval = 1 / fps
+        self.tasks: List[Progress] = []
+        self.enabled = colors_enabled(fileobj)
+        self._drawn_lines = 0
+        self._last_frame: Optional[str] = None
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self) -> "ProgressGroup":
+        self.start()
+        return self
+
+    def __exit__(self, *unused: Any) -> None:
+        self.stop()
+
+    def add(self, description: str, total: Optional[int] = None) -> Progress:
+        """Add a line to the group. Call ``update()`` on the returned
+        :class:`Progress` to report progress. Each of them should be
+        updated by only one thread at a time."""
+        progress = Progress(description, total, fileobj=self.fileobj)
+        # Drawing is done by the group, so update() only has to count
+        progress.enabled = False
+        progress.next_check = sys.maxsize
+        self.tasks.append(progress)
+        return progress
+
+    def start(self) -> None:
+        """Start redrawing the lines"""
+        if not self.enabled or self._thread:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="cli_ui-progress", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop redrawing, after drawing the final state"""
+        if self._thread:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+        if self.enabled:
+            self.draw()
+
+    def draw(self) -> None:
+        now = time.monotonic()
+        lines = []
+        for progress in list(self.tasks):
+            progress.measure(now)
+            lines.append(progress.line())
+        frame = "".join(line + "\x1b[K\n" for line in lines)
+        if frame == self._last_frame:
+            return
+        self._last_frame = frame
+        if self._drawn_lines:
+            # Go back to the first line of the group
+            frame = "\r\x1b[%dA" % self._drawn_lines + frame
+        self._drawn_lines = len(lines)
+        _emit(self.fileobj, frame, complete=True)
+
+    def _run(self) -> None:
+        while not self._stopping.wait(self.interval):
+            self.draw()
+
+
+T = TypeVar("T")
+
+
+def track(
+    iterable: Iterable[T],
+    description: str = "",
+    *,
+    total: Optional[int] = None,
+    **kwargs: Any,
+) -> Iterator[T]:
+    """Iterate over ``iterable`` while displaying a :class:`Progress`.
+
+    ``total`` defaults to ``len(iterable)`` when available. Other keyword
+    arguments are passed to :class:`Progress`.
+
+    ::
+
+        >>> for file in cli_ui.track(files, "Copying"):
+        ...     copy(file)
+    """
+    if total is None:
+        try:
+            total = len(iterable)  # type: ignore[arg-type]
+        except TypeError:
+            total = None
+    with Progress(description, total, **kwargs) as progress:
+        # Same as calling progress.update() in the loop, without the
+        # overhead of a method call for each item
+        count = 0
+        try:
+            for item in iterable:
+                yield item
+                count += 1
+                if count >= progress.next_check:
+                    progress.count = count
+                    progress.check()
+        finally:
+            progress.count = count
+
+
+def enabled_for(level: str) -> bool:
+    """Return whether messages of the given level are currently shown.
+
+    Use it to skip preparing messages that would not be written anyway::
+
+        >>> if cli_ui.enabled_for("debug"):
+        ...     cli_ui.debug(*describe(state))
+
+    :param level: one of ``"debug"``, ``"info"``, ``"warning"`` or ``"error"``
+    """
+    if level == "debug":
+        return bool(CONFIG["verbose"]) and not CONFIG["record"]
+    if level == "info":
+        return not CONFIG["quiet"]
+    if level in ("warning", "error"):
+        return True
+    raise ValueError("Unknown level: %s" % level)
 
 
 def debug(*tokens: Token, **kwargs: Any) -> None:
@@ -380,7 +2186,7 @@ def debug(*tokens: Token, **kwargs: Any) -> None:
     """
     if not CONFIG["verbose"] or CONFIG["record"]:
         return
-    message(*tokens, **kwargs)
+    message(_DEBUG_TEMPLATE, *tokens, **kwargs)
 
 
 def indent_iterable(elems: Sequence[str], num: int = 2) -> List[str]:
@@ -402,39 +2208,203 @@ def tabs(num: int) -> str:
 def info_table(
     data: Any, *, headers: Union[str, Sequence[str]] = (), fileobj: FileObj = sys.stdout
 ) -> None:
+    if CONFIG["format"] == "jsonl":
+        for records in _jsonl_rows(data, headers, _stream_name(fileobj)):
+            _emit(fileobj, records, complete=True)
+        return
+    _emit(fileobj, _table_string(data, headers, fileobj), complete=True)
+
+
+def _table_string(
+    data: Any, headers: Union[str, Sequence[str]], fileobj: FileObj
+) -> str:
+    use_colors = colors_enabled(fileobj)
+
+    def render(item: Sequence[Token]) -> str:
+        return RenderedTokens(item, end="").get(use_colors)
+
+    data_for_tabulate: Any
     if headers == "keys":
-        colored_data: Any = {}
-        plain_data: Any = {}
-        for key, sequence in data.items():
-            colored_sequence = []
-            plain_sequence = []
-            for item in sequence:
-                colored_str, plain_str = process_tokens(item, end="")
-                colored_sequence.append(colored_str)
-                plain_sequence.append(plain_str)
-            colored_key, plain_key = process_tokens(key, end="")
-            colored_data[colored_key] = colored_sequence
-            plain_data[plain_key] = plain_sequence
-    else:
-        colored_data = []
-        plain_data = []
-        for row in data:
-            colored_row = []
-            plain_row = []
-            for item in row:
-                colored_str, plain_str = process_tokens(item, end="")
-                colored_row.append(colored_str)
-                plain_row.append(plain_str)
-            colored_data.append(colored_row)
-            plain_data.append(plain_row)
-    if colors_enabled(fileobj):
-        data_for_tabulate = colored_data
+        data_for_tabulate = {
+            render(key): [render(item) for item in sequence]
+            for key, sequence in data.items()
+        }
     else:
-        data_for_tabulate = plain_data
+        data_for_tabulate = [[render(item) for item in row] for row in data]
+
+    import tabulate
 
     res = tabulate.tabulate(data_for_tabulate, headers=headers)
     res += "\n"
-    write_and_flush(fileobj, res)
+    return res
+
+
+# The following helpers detect numbers the same way tabulate does
+
+_THOUSANDS_SEPARATORS = re.compile(
+    r"^(([+-]?[0-9]{1,3})(?:,([0-9]{3}))*)?(?(1)\.[0-9]*|\.[0-9]+)?$"
+)
+
+
+def _is_number(text: str) -> bool:
+    try:
+        value = float(text)
+    except ValueError:
+        return bool(_THOUSANDS_SEPARATORS.match(text))
+    if math.isinf(value) or math.isnan(value):
+        # Overflows such as 1e999 are not numbers
+        return text.lower() in ("inf", "-inf", "nan")
+    return True
+
+
+def _is_int(text: str) -> bool:
+    try:
+        int(text)
+    except ValueError:
+        return "." not in text and bool(_THOUSANDS_SEPARATORS.match(text))
+    return True
+
+
+def _decimals(text: str) -> int:
+    """Number of characters after the decimal point or the exponent
+    mark, -1 if there are none"""
+    if not _is_number(text) or _is_int(text):
+        return -1
+    pos = text.rfind(".")
+    if pos < 0:
+        pos = text.lower().rfind("e")
+    return len(text) - pos - 1 if pos >= 0 else -1
+
+
+def info_table_stream(
+    rows: Iterable[Sequence[Sequence[Token]]],
+    *,
+    headers: Sequence[str] = (),
+    widths: Optional[Sequence[int]] = None,
+    sample_size: int = 1000,
+    fileobj: FileObj = sys.stdout,
+) -> None:
+    """Like :func:`info_table`, but write rows as they come, so that
+    huge tables do not have to fit in memory.
+
+    Only the first ``sample_size`` rows are read before writing anything.
+    They are used to compute the width and the alignment of each column,
+    unless ``widths`` is given. Cells wider than their column in later
+    rows are not truncated.
+
+    :param rows: any iterable of rows, in the same format as for :func:`info_table`
+    :param headers: the name of each column
+    :param widths: the width of each column
+    :param sample_size: how many rows to look at before writing
+    """
+    if CONFIG["format"] == "jsonl":
+        for records in _jsonl_rows(rows, headers, _stream_name(fileobj)):
+            _emit(fileobj, records, complete=True)
+        return
+    use_colors = colors_enabled(fileobj)
+
+    def render(item: Sequence[Token]) -> Tuple[str, str]:
+        rendered = RenderedTokens(item, end="")
+        if use_colors:
+            return rendered.both()
+        plain = rendered.without_color
+        return (plain, plain)
+
+    rows = iter(rows)
+    sample = [
+        [render(item) for item in row] for row in itertools.islice(rows, sample_size)
+    ]
+    num_columns = max([len(headers)] + [len(row) for row in sample])
+
+    # Columns are numeric when they contain numbers only, and at
+    # least one of them
+    numeric = [False] * num_columns
+    texts = [False] * num_columns
+    floats = [False] * num_columns
+    for row in sample:
+        for i, (_, plain) in enumerate(row):
+            if not plain or texts[i]:
+                continue
+            if _is_number(plain):
+                numeric[i] = True
+                floats[i] = floats[i] or not _is_int(plain)
+            else:
+                numeric[i] = False
+                texts[i] = True
+    float_columns = [i for i in range(num_columns) if numeric[i] and floats[i]]
+
+    def normalize(row: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        # Like tabulate, numbers in columns of floats are written with
+        # the "g" format: "1.50" becomes "1.5" and "1e5" becomes "100000"
+        for i in float_columns:
+            if i >= len(row):
+                break
+            text, plain = row[i]
+            try:
+                formatted = format(float(plain.replace(",", "")), "g")
+            except ValueError:
+                continue
+            row[i] = (text.replace(plain, formatted), formatted)
+        return row
+
+    if float_columns:
+        sample = [normalize(row) for row in sample]
+
+    # Numbers are aligned on the decimal point, like tabulate does
+    max_decimals = [-1] * num_columns
+    for row in sample:
+        for i, (_, plain) in enumerate(row):
+            if numeric[i]:
+                max_decimals[i] = max(max_decimals[i], _decimals(plain))
+    computed_widths = [len(header) + 2 for header in headers]
+    computed_widths += [0] * (num_columns - len(headers))
+    for row in sample:
+        for i, (_, plain) in enumerate(row):
+            width = len(plain)
+            if numeric[i]:
+                width += max_decimals[i] - _decimals(plain)
+            computed_widths[i] = max(computed_widths[i], width)
+    column_widths = computed_widths if widths is None else widths
+
+    def pad(i: int, text: str, plain: str, *, header: bool = False) -> str:
+        if i >= len(column_widths) or i >= num_columns:
+            return text
+        width = column_widths[i]
+        if not numeric[i]:
+            return text + " " * (width - len(plain))
+        right = 0
+        if not header:
+            right = max(max_decimals[i] - _decimals(plain), 0)
+        left = max(width - right - len(plain), 0)
+        return " " * left + text + " " * right
+
+    def format_row(row: Sequence[Tuple[str, str]], *, header: bool = False) -> str:
+        cells = [
+            pad(i, text, plain, header=header) for i, (text, plain) in enumerate(row)
+        ]
+        return "  ".join(cells).rstrip() + "\n"
+
+    separator = "  ".join("-" * width for width in column_widths) + "\n"
+    lines = []
+    if headers:
+        lines.append(format_row([(h, h) for h in headers], header=True))
+    lines.append(separator)
+    lines.extend(format_row(row) for row in sample)
+    del sample
+    _emit(fileobj, "".join(lines), complete=True)
+
+    # Write by batches, to avoid one system call per row
+    batch_size = 1000
+    while True:
+        batch = [
+            format_row(normalize([render(item) for item in row]))
+            for row in itertools.islice(rows, batch_size)
+        ]
+        if not batch:
+            break
+        _emit(fileobj, "".join(batch), complete=True)
+    if not headers:
+        _emit(fileobj, separator, complete=True)
 
 
 def message_for_exception(exception: Exception, message: str) -> Sequence[Token]:
@@ -447,6 +2417,8 @@ def message_for_exception(exception: Exception, message: str) -> Sequence[Token]
     than the main one.
 
     """
+    import traceback
+
     tb = sys.exc_info()[2]
     buffer = io.StringIO()
     traceback.print_tb(tb, file=buffer)
@@ -463,12 +2435,16 @@ def message_for_exception(exception: Exception, message: str) -> Sequence[Token]
 def read_input() -> str:
     """Read input from the user"""
     info(green, "> ", end="")
+    flush()
     return input()
 
 
 def read_password() -> str:
     """Read a password from the user"""
     info(green, "> ", end="")
+    flush()
+    import getpass
+
     return getpass.getpass(prompt="")
 
 
@@ -499,11 +2475,138 @@ def ask_password(*question: Token) -> str:
 FuncDesc = Callable[[Any], str]
 
 
+class _ChoiceList:
+    """The list of choices displayed by :func:`ask_choice` and
+    :func:`select_choices`.
+
+    Descriptions are computed once. When a page size is given, only one
+    page of the list is displayed at a time, and answers that are not
+    numbers are used to filter the list.
+    """
+
+    def __init__(
+        self,
+        choices: Sequence[Any],
+        func_desc: Optional[FuncDesc],
+        sort: Optional[bool],
+        page_size: Optional[int],
+    ):
+        if func_desc is None:
+            func_desc = str
+        descriptions = [func_desc(choice) for choice in choices]
+        if sort:
+            order = sorted(range(len(choices)), key=descriptions.__getitem__)
+            self.choices = [choices[i] for i in order]
+            self.descriptions = [descriptions[i] for i in order]
+        else:
+            self.choices = list(choices)
+            self.descriptions = descriptions
+        self.page_size = page_size
+        self.page = 0
+        self.query = ""
+        # Indexes of the choices matching the query
+        self.matches: Sequence[int] = range(len(self.choices))
+        self._lowered: Optional[List[str]] = None
+        self._index: Optional[SuggestionIndex] = None
+
+    def __len__(self) -> int:
+        return len(self.choices)
+
+    def display(self) -> None:
+        if self.page_size is None:
+            shown = self.matches
+        else:
+            start = self.page * self.page_size
+            stop = start + self.page_size
+            shown = self.matches[start:stop]
+        tokens: List[Token] = []
+        for i in shown:
+            tokens.extend(["   ", blue, "%i" % (i + 1), reset])
+            tokens.append(" %s\n" % self.descriptions[i])
+        info(*tokens, sep="", end="")
+        if self.page_size is None:
+            return
+        if shown:
+            status = "Showing %i-%i of %i" % (
+                start + 1,
+                start + len(shown),
+                len(self.matches),
+            )
+        else:
+            status = "No match"
+        if self.query:
+            status += " matching '%s'" % self.query
+        info(
+            faint,
+            status + ". Type some text to filter, '+' or '-' to change page",
+        )
+
+    def handle_command(self, answer: str) -> bool:
+        """Change page or filter the list, returning False if the answer
+        was not a command (or when paging is disabled)"""
+        if self.page_size is None:
+            return False
+        if answer in ("+", "-"):
+            num_pages = max(1, -(-len(self.matches) // self.page_size))
+            step = 1 if answer == "+" else -1
+            self.page = min(max(self.page + step, 0), num_pages - 1)
+        else:
+            self.filter(answer)
+        self.display()
+        return True
+
+    def filter(self, query: str) -> None:
+        lowered_query = query.lower()
+        if self._lowered is None:
+            self._lowered = [desc.lower() for desc in self.descriptions]
+        lowered = self._lowered
+        # A longer query can only narrow down the previous matches
+        if self.query and self.query.lower() in lowered_query:
+            candidates: Iterable[int] = self.matches
+        else:
+            candidates = range(len(self.choices))
+        matches = [i for i in candidates if lowered_query in lowered[i]]
+        if not matches:
+            matches = self._fuzzy_matches(query)
+        self.query = query
+        self.matches = matches
+        self.page = 0
+
+    def _fuzzy_matches(self, query: str) -> List[int]:
+        if self._index is None:
+            self._index = SuggestionIndex(self.descriptions)
+        assert self.page_size is not None
+        suggestions = self._index.suggest(query, limit=self.page_size, cutoff=0.6)
+        positions: Dict[str, List[int]] = {}
+        for i, desc in enumerate(self.descriptions):
+            positions.setdefault(desc, []).append(i)
+        return [i for desc in suggestions for i in positions[desc]]
+
+
+def _parse_selection(answer: str) -> List[range]:
+    """Parse a selection like '1, 3-250 7' into ranges of 1-based indexes.
+
+    Raise ValueError if one of the items is not a number or a range.
+    """
+    res = []
+    for item in re.split(r"[;,\s]+", answer.strip()):
+        if not item:
+            continue
+        first, dash, last = item.partition("-")
+        start = int(first)
+        stop = int(last) if dash else start
+        res.append(range(start, stop + 1))
+    if not res:
+        raise ValueError(answer)
+    return res
+
+
 def ask_choice(
     *prompt: Token,
-    choices: List[Any],
+    choices: Sequence[Any],
     func_desc: Optional[FuncDesc] = None,
     sort: Optional[bool] = True,
+    page_size: Optional[int] = None,
 ) -> Any:
     """Ask the user to choose from a list of choices.
 
@@ -519,48 +2622,44 @@ def ask_choice(
                 sort the list of choices (unless ``sort`` is False)
                 Defaults to the identity function.
     :param sort: whether to sort the list of choices.
+    :param page_size: if set, display this many choices at a time, and
+                let the user filter the list by typing some text,
+                or change page with '+' and '-'.
 
     :return: the selected choice.
 
     """
-    if func_desc is None:
-        func_desc = lambda x: str(x)
+    choice_list = _ChoiceList(choices, func_desc, sort, page_size)
     tokens = get_ask_tokens(prompt)
     info(*tokens)
-    if sort:
-        choices.sort(key=func_desc)
-    for i, choice in enumerate(choices, start=1):
-        choice_desc = func_desc(choice)
-        info("  ", blue, "%i" % i, reset, choice_desc)
-    keep_asking = True
-    res = None
-    while keep_asking:
+    choice_list.display()
+    while True:
         answer = read_input()
         if not answer:
             return None
         try:
             index = int(answer)
         except ValueError:
-            info("Please enter a valid number")
+            if not choice_list.handle_command(answer):
+                info("Please enter a valid number")
             continue
-        if index not in range(1, len(choices) + 1):
+        if index not in range(1, len(choice_list) + 1):
             info(str(index), "is out of range")
             continue
-        res = choices[index - 1]
-        keep_asking = False
-
-    return res
+        return choice_list.choices[index - 1]
 
 
 def select_choices(
     *prompt: Token,
-    choices: List[Any],
+    choices: Sequence[Any],
     func_desc: Optional[FuncDesc] = None,
     sort: Optional[bool] = True,
+    page_size: Optional[int] = None,
 ) -> Any:
     """
     Ask the user to select one or multiple from a list of choices,
-    delimited by space, comma or semi colon.
+    delimited by space, comma or semi colon. Ranges such as ``3-250``
+    are accepted too.
 
     Will loop until:
 
@@ -575,44 +2674,32 @@ def select_choices(
                 sort the list of choices (unless ``sort`` is False)
                 Defaults to the identity function.
     :param sort: whether to sort the list of choices.
+    :param page_size: same as in :func:`ask_choice`
 
     :return: the selected choice(s).
 
     """
-    if func_desc is None:
-        func_desc = lambda x: str(x)
+    choice_list = _ChoiceList(choices, func_desc, sort, page_size)
     tokens = get_ask_tokens(prompt)
     info(*tokens)
-    if sort:
-        choices.sort(key=func_desc)
-    for i, choice in enumerate(choices, start=1):
-        choice_desc = func_desc(choice)
-        info("  ", blue, "%i" % i, reset, choice_desc)
-    keep_asking = True
-    res = None
-    while keep_asking:
+    choice_list.display()
+    valid = range(1, len(choice_list) + 1)
+    while True:
         answer = read_input()
         if not answer:
             return None
         try:
-
-            index = [int(item) for item in re.split(r"; |, |\s |;|,|\s", answer)]
-            index = [x - 1 for x in index]  # convert to true index
+            selection = _parse_selection(answer)
         except ValueError:
-            info("Please enter a valid number")
+            if not choice_list.handle_command(answer):
+                info("Please enter a valid number")
             continue
 
-        try:
-            res = (
-                list(itemgetter(*index)(choices))
-                if len(index) > 1
-                else [itemgetter(*index)(choices)]
-            )
-        except Exception:
+        if not all(r and r[0] in valid and r[-1] in valid for r in selection):
             info("Please enter valid selection number(s)")
             continue
 
-        return res
+        return [choice_list.choices[i - 1] for r in selection for i in r]
 
 
 def ask_yes_no(*question: Token, default: bool = False) -> bool:
@@ -637,22 +2724,132 @@ def ask_yes_no(*question: Token, default: bool = False) -> bool:
 AnyFunc = Callable[..., Any]
 
 
+# Path of the innermost running timer, as a tuple of descriptions.
+# Context variables keep spans from different threads and asyncio
+# tasks apart.
+_CURRENT_SPAN: "contextvars.ContextVar[Tuple[str, ...]]" = contextvars.ContextVar(
+    "cli_ui_span", default=()
+)
+
+# Number of durations kept per span to estimate percentiles
+_SPAN_SAMPLE_SIZE = 1024
+
+
+class _Span:
+    """Statistics about the runs of a timer, in nanoseconds.
+
+    Memory use does not depend on the number of runs: percentiles are
+    computed from a uniform sample of the durations (reservoir sampling),
+    which holds all of them until there are more than
+    ``_SPAN_SAMPLE_SIZE``.
+    """
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0
+        self.sample: List[int] = []
+        self._random: Any = None
+        # Algorithm L: instead of drawing a random number for each run,
+        # compute which run replaces a sampled duration next
+        self._weight = 1.0
+        self._next_replacement = 0
+
+    def add(self, duration: int) -> None:
+        self.count += 1
+        self.total += duration
+        if self.count < self._next_replacement:
+            return
+        if len(self.sample) < _SPAN_SAMPLE_SIZE:
+            self.sample.append(duration)
+            if len(self.sample) == _SPAN_SAMPLE_SIZE:
+                self._plan_replacement()
+            return
+        self.sample[self._random.randrange(len(self.sample))] = duration
+        self._plan_replacement()
+
+    def _plan_replacement(self) -> None:
+        if self._random is None:
+            import random
+
+            self._random = random.Random()
+        self._weight *= math.exp(math.log(self._uniform()) / len(self.sample))
+        skip = math.floor(math.log(self._uniform()) / math.log(1 - self._weight))
+        self._next_replacement = self.count + skip + 1
+
+    def _uniform(self) -> float:
+        # In (0, 1), so that its logarithm is defined and negative
+        value: float = self._random.random()
+        return value if value > 0 else 0.5
+
+
+# path -> statistics of its runs. Entries are added when timers start,
+# so parents come before their children.
+_SPANS: Dict[Tuple[str, ...], _Span] = {}
+_SPANS_LOCK = threading.Lock()
+
+
 class Timer:
-    """Display time taken when executing a list of statements."""
+    """Display time taken when executing a list of statements.
+
+    Timers started while another one is running are nested in it.
+    Statistics about every run are kept, so that repeated timers can be summarized
+    with :func:`info_timers` or exported with :func:`timer_report`.
+
+    Sections can also be profiled. When the timer stops, the functions
+    taking the most time or the lines allocating the most memory are
+    displayed in a table.
+
+    :param description: name of the timer
+    :param log: Whether to display the time taken each time the timer stops
+    :param profile: Whether to run the section under :mod:`cProfile`
+    :param memory: Whether to trace memory allocations of the section
+                   with :mod:`tracemalloc`
+    :param top: How many functions or allocation sites to display
+    :param profile_path: Write the :mod:`cProfile` statistics to this file
+                   instead of displaying them, for instance to open them with
+                   :mod:`pstats` or snakeviz. Implies ``profile=True``.
+    """
 
-    def __init__(self, description: str):
+    def __init__(
+        self,
+        description: str,
+        *,
+        log: bool = True,
+        profile: bool = False,
+        memory: bool = False,
+        top: int = 10,
+        profile_path: Optional[str] = None,
+    ):
         self.description = description
-        self.start_time = datetime.datetime.now()
-        self.stop_time = datetime.datetime.now()
-        self.elapsed_time = 0
+        self.log = log
+        self.profile = profile or profile_path is not None
+        self.memory = memory
+        self.top = top
+        self.profile_path = profile_path
+        self._profiler: Optional[_SectionProfiler] = None
+        self.elapsed_ns = 0
+        self._path: Tuple[str, ...] = (description,)
+        self._token: "Optional[contextvars.Token[Tuple[str, ...]]]" = None
+        self._start_ns = time.perf_counter_ns()
 
     def __call__(self, func: AnyFunc, *args: Any, **kwargs: Any) -> AnyFunc:
         @functools.wraps(func)
         def res(*args: Any, **kwargs: Any) -> Any:
-            self.start()
-            ret = func(*args, **kwargs)
-            self.stop()
-            return ret
+            # One timer per call, so that recursive and concurrent
+            # calls are measured separately
+            timer = Timer(
+                self.description,
+                log=self.log,
+                profile=self.profile,
+                memory=self.memory,
+                top=self.top,
+                profile_path=self.profile_path,
+            )
+            try:
+                with timer:
+                    return func(*args, **kwargs)
+            finally:
+                self.elapsed_ns = timer.elapsed_ns
 
         return res
 
@@ -663,45 +2860,381 @@ class Timer:
     def __exit__(self, *unused: Any) -> None:
         self.stop()
 
+    @property
+    def elapsed(self) -> float:
+        """Duration of the last run, in seconds"""
+        return self.elapsed_ns / 1e9
+
     def start(self) -> None:
         """Start the timer"""
-        self.start_time = datetime.datetime.now()
+        self._path = _CURRENT_SPAN.get() + (self.description,)
+        self._token = _CURRENT_SPAN.set(self._path)
+        with _SPANS_LOCK:
+            if self._path not in _SPANS:
+                _SPANS[self._path] = _Span()
+        if self.profile or self.memory:
+            self._profiler = _SectionProfiler(
+                cpu=self.profile, memory=self.memory, path=self.profile_path
+            )
+            self._profiler.start()
+        self._start_ns = time.perf_counter_ns()
 
     def stop(self) -> None:
         """Stop the timer and emit a nice log"""
-        end_time = datetime.datetime.now()
-        elapsed_time = end_time - self.start_time
-        elapsed_seconds = elapsed_time.seconds
-        hours, remainder = divmod(int(elapsed_seconds), 3600)
-        minutes, seconds = divmod(remainder, 60)
-        as_str = "%sh %sm %ss %dms" % (
-            hours,
-            minutes,
-            seconds,
-            elapsed_time.microseconds / 1000,
+        self.elapsed_ns = time.perf_counter_ns() - self._start_ns
+        profiler = self._profiler
+        if profiler is not None:
+            profiler.stop()
+            self._profiler = None
+        if self._token is not None:
+            try:
+                _CURRENT_SPAN.reset(self._token)
+            except ValueError:
+                # Stopped from another thread or task
+                pass
+            self._token = None
+        with _SPANS_LOCK:
+            span = _SPANS.get(self._path)
+            if span is None:
+                span = _SPANS[self._path] = _Span()
+            span.add(self.elapsed_ns)
+        if self.log:
+            self._log()
+        if profiler is not None:
+            profiler.report(self.description, self.top)
+
+    def _log(self) -> None:
+        if CONFIG["quiet"]:
+            return
+        milliseconds, _ = divmod(self.elapsed_ns, 1_000_000)
+        seconds, milliseconds = divmod(milliseconds, 1000)
+        minutes, seconds = divmod(seconds, 60)
+        hours, minutes = divmod(minutes, 60)
+        as_str = "%sh %sm %ss %dms" % (hours, minutes, seconds, milliseconds)
+        indent = "  " * (len(self._path) - 1)
+        info(
+            "%s%s took %s" % (indent, self.description, as_str),
+            fields={
+                "timer": self.description,
+                "span": list(self._path),
+                "seconds": self.elapsed,
+            },
+        )
+
+
+# Only one cProfile profiler can be enabled at a time: sections
+# nested in a profiled one are part of its profile
+_PROFILER_ACTIVE = False
+
+
+class _SectionProfiler:
+    """Profile a section measured by a :class:`Timer`"""
+
+    def __init__(self, *, cpu: bool, memory: bool, path: Optional[str]):
+        self.cpu = cpu
+        self.memory = memory
+        self.path = path
+        self.profiler: Any = None
+        # tracemalloc snapshots taken at the start and at the end
+        self.before: Any = None
+        self.after: Any = None
+        self.started_tracing = False
+
+    def start(self) -> None:
+        global _PROFILER_ACTIVE
+        profiler = None
+        if self.cpu and not _PROFILER_ACTIVE:
+            import cProfile
+
+            profiler = cProfile.Profile()
+        if self.memory:
+            import tracemalloc
+
+            self.started_tracing = not tracemalloc.is_tracing()
+            if self.started_tracing:
+                tracemalloc.start()
+            self.before = _take_snapshot()
+        if profiler is not None:
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiler is already running
+                return
+            self.profiler = profiler
+            _PROFILER_ACTIVE = True
+
+    def stop(self) -> None:
+        global _PROFILER_ACTIVE
+        if self.profiler is not None:
+            self.profiler.disable()
+            _PROFILER_ACTIVE = False
+        if self.before is not None:
+            import tracemalloc
+
+            self.after = _take_snapshot()
+            if self.started_tracing:
+                tracemalloc.stop()
+
+    def report(self, description: str, top: int) -> None:
+        if self.profiler is not None:
+            if self.path is not None:
+                self.profiler.dump_stats(self.path)
+                info("Profile of", description, "written to", self.path)
+            else:
+                _info_profile(description, self.profiler, top)
+        if self.after is not None:
+            differences = self.after.compare_to(self.before, "lineno")
+            _info_allocations(description, differences, top)
+
+
+def _take_snapshot() -> Any:
+    import tracemalloc
+
+    # Leave out the allocations of the import system and of tracemalloc itself
+    return tracemalloc.take_snapshot().filter_traces(
+        [
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ]
+    )
+
+
+def _info_profile(description: str, profiler: Any, top: int) -> None:
+    import pstats
+
+    # (filename, line, name) -> (primitive calls, calls, own time,
+    # cumulative time, callers)
+    functions = pstats.Stats(profiler).stats  # type: ignore[attr-defined]
+    hottest = heapq.nlargest(top, functions.items(), key=lambda item: item[1][2])
+    rows = []
+    for (filename, line, name), (_, calls, own_time, cumulative_time, _) in hottest:
+        if filename != "~":
+            # Not a built-in function
+            name = "%s:%d(%s)" % (os.path.basename(filename), line, name)
+        rows.append(
+            [(name,), (calls,), ("%.3f" % own_time,), ("%.3f" % cumulative_time,)]
+        )
+    info_2("Functions taking the most time in", description)
+    info_table(rows, headers=["function", "calls", "own (s)", "cumulative (s)"])
+
+
+def _info_allocations(description: str, differences: Any, top: int) -> None:
+    rows = []
+    for difference in differences[:top]:
+        frame = difference.traceback[0]
+        rows.append(
+            [
+                ("%s:%d" % (os.path.basename(frame.filename), frame.lineno),),
+                ("%.1f" % (difference.size_diff / 1024),),
+                (difference.count_diff,),
+            ]
+        )
+    info_2("Lines allocating the most memory in", description)
+    info_table(rows, headers=["line", "size (KiB)", "blocks"])
+
+
+def _span_stats(count: int, total: int, sample: List[int]) -> Dict[str, Any]:
+    if not count:
+        return {"count": 0, "total": 0.0, "mean": 0.0, "p50": 0.0, "p95": 0.0}
+    ordered = sorted(sample)
+
+    def percentile(q: float) -> float:
+        # Nearest-rank method
+        return ordered[max(math.ceil(q * len(ordered)) - 1, 0)] / 1e9
+
+    return {
+        "count": count,
+        "total": total / 1e9,
+        "mean": total / count / 1e9,
+        "p50": percentile(0.5),
+        "p95": percentile(0.95),
+    }
+
+
+def _span_tree() -> List[Dict[str, Any]]:
+    with _SPANS_LOCK:
+        spans = [
+            (path, span.count, span.total, list(span.sample))
+            for path, span in _SPANS.items()
+        ]
+    roots: List[Dict[str, Any]] = []
+    nodes: Dict[Tuple[str, ...], Dict[str, Any]] = {}
+    for path, count, total, sample in spans:
+        node = {"name": path[-1], **_span_stats(count, total, sample), "children": []}
+        nodes[path] = node
+        parent = nodes.get(path[:-1])
+        if parent is None:
+            roots.append(node)
+        else:
+            parent["children"].append(node)
+    return roots
+
+
+def timer_report(path: Optional[str] = None) -> Dict[str, Any]:
+    """Return statistics about every :class:`Timer` run so far, as
+    a tree of spans.
+
+    Each span has a ``name``, the number of runs (``count``), the
+    ``total``, ``mean``, median (``p50``) and 95th percentile (``p95``)
+    of their durations in seconds, and its ``children``. Past 1024 runs,
+    percentiles are estimated from a random sample of 1024 durations.
+
+    :param path: if given, also write the report to this file as JSON,
+                 for instance to compare it with the one of another run
+    """
+    report = {"spans": _span_tree()}
+    if path is not None:
+        import json
+
+        with open(path, "w") as fp:
+            json.dump(report, fp, indent=2)
+            fp.write("\n")
+    return report
+
+
+def info_timers(*, fileobj: FileObj = sys.stdout) -> None:
+    """Display a table with the statistics of every :class:`Timer`,
+    nested spans being indented below their parent.
+    See :func:`timer_report`."""
+    rows = []
+
+    def add_rows(nodes: List[Dict[str, Any]], depth: int) -> None:
+        for node in nodes:
+            row = [("  " * depth + node["name"],), (node["count"],)]
+            for key in ("total", "mean", "p50", "p95"):
+                row.append(("%.3f" % node[key],))
+            rows.append(row)
+            add_rows(node["children"], depth + 1)
+
+    add_rows(_span_tree(), 0)
+    if not rows:
+        return
+    headers = ["timer", "count", "total (s)", "mean (s)", "p50 (s)", "p95 (s)"]
+    info_table_stream(rows, headers=headers, fileobj=fileobj)
+
+
+def reset_timers() -> None:
+    """Forget the runs of every :class:`Timer`"""
+    with _SPANS_LOCK:
+        _SPANS.clear()
+
+
+def _info_timers_at_exit() -> None:
+    if not CONFIG["timer_summary"]:
+        return
+    try:
+        info_timers()
+    except (OSError, ValueError):
+        # Stream already closed, nothing we can do
+        pass
+
+
+# Registered after _flush_at_exit(), so that it runs before it
+atexit.register(_info_timers_at_exit)
+
+
+def _trigrams(text: str) -> Set[str]:
+    padded = "  %s " % text.lower()
+    return {a + b + c for a, b, c in zip(padded, padded[1:], padded[2:])}
+
+
+class SuggestionIndex:
+    """Find the choices closest to a user input, as measured by
+    :meth:`difflib.SequenceMatcher.ratio`.
+
+    Build it once for a list of choices, then query it as many times
+    as needed. Choices are first filtered with cheap upper bounds of
+    the ratio, so that the full computation only runs for promising ones.
+
+    When there are more than ``exhaustive_limit`` choices, only those
+    sharing the most trigrams with the input are considered.
+    """
+
+    def __init__(self, choices: Iterable[str], *, exhaustive_limit: int = 2000):
+        self.choices = list(choices)
+        self.exhaustive_limit = exhaustive_limit
+        # trigram -> indexes of the choices containing it
+        self._postings: Dict[str, List[int]] = {}
+        if len(self.choices) > exhaustive_limit:
+            for i, choice in enumerate(self.choices):
+                for trigram in _trigrams(choice):
+                    self._postings.setdefault(trigram, []).append(i)
+
+    def _candidates(self, user_input: str) -> Iterable[int]:
+        if len(self.choices) <= self.exhaustive_limit:
+            return range(len(self.choices))
+        shared: Dict[int, int] = {}
+        for trigram in _trigrams(user_input):
+            for i in self._postings.get(trigram, ()):
+                shared[i] = shared.get(i, 0) + 1
+        if not shared:
+            return range(len(self.choices))
+        best = heapq.nlargest(
+            self.exhaustive_limit, shared.items(), key=lambda item: (item[1], -item[0])
         )
-        info("%s took %s" % (self.description, as_str))
+        return sorted(i for i, _ in best)
+
+    def suggest(
+        self, user_input: str, *, limit: int = 1, cutoff: float = 0.0
+    ) -> List[str]:
+        """Return at most ``limit`` choices, best match first.
+
+        Ties are broken by keeping the order of the choices.
+
+        :param cutoff: ignore choices with a ratio lower than this
+        """
+        if limit < 1:
+            return []
+        # (ratio, -index) of the best choices so far, worst one first
+        best: List[Tuple[float, int]] = []
+        import difflib
+
+        # seq2 is fixed, so that SequenceMatcher only analyzes it once.
+        # The bounds are symmetric, the actual ratio is not.
+        bounds = difflib.SequenceMatcher(b=user_input)
+        for i in self._candidates(user_input):
+            choice = self.choices[i]
+            threshold = best[0][0] if len(best) == limit else cutoff
+            bounds.set_seq1(choice)
+            if bounds.real_quick_ratio() < threshold:
+                continue
+            if bounds.quick_ratio() < threshold:
+                continue
+            ratio = difflib.SequenceMatcher(a=user_input, b=choice).ratio()
+            if ratio < cutoff:
+                continue
+            if len(best) < limit:
+                heapq.heappush(best, (ratio, -i))
+            elif (ratio, -i) > best[0]:
+                heapq.heapreplace(best, (ratio, -i))
+        return [self.choices[-i] for _, i in sorted(best, reverse=True)]
+
+
+@functools.lru_cache(maxsize=8)
+def _suggestion_index(choices: Tuple[str, ...]) -> SuggestionIndex:
+    return SuggestionIndex(choices)
 
 
 def did_you_mean(message: str, user_input: str, choices: Sequence[str]) -> str:
     """Given a list of choices and an invalid user input, display the closest
     items in the list that match the input.
 
+    The :class:`SuggestionIndex` built for the list of choices is re-used
+    when calling this function again with the same choices.
     """
     if not choices:
         return message
     else:
-        result = {
-            difflib.SequenceMatcher(a=user_input, b=choice).ratio(): choice
-            for choice in choices
-        }
-        message += "\nDid you mean: %s?" % result[max(result)]
+        index = _suggestion_index(tuple(choices))
+        (suggestion,) = index.suggest(user_input, limit=1)
+        message += "\nDid you mean: %s?" % suggestion
         return message
 
 
 def main_test_colors() -> None:
     this_module = sys.modules[__name__]
-    for name, value in inspect.getmembers(this_module):
+    for name, value in sorted(vars(this_module).items()):
         if isinstance(value, Color):
             info(value, name)
 
@@ -749,6 +3282,8 @@ def main_demo() -> None:
 
 
 def main() -> None:
+    import argparse
+
     parser = argparse.ArgumentParser()
     parser.add_argument("--color", choices=["always", "never", "auto"])
     parser.add_argument("action", choices=["test_colors", "demo"])
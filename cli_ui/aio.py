@@ -0,0 +1,195 @@
+"""Awaitable versions of the message functions, for use in asyncio programs.
+
+Messages are rendered exactly like their synchronous counterparts, but
+streams backed by a file descriptor (terminals, pipes, sockets and files)
+are written to from a dedicated thread, so that a slow reader does not
+block the event loop. Each call waits for its message to be written,
+which keeps tasks that log a lot from piling up messages in memory.
+
+The file descriptors stay in blocking mode: making them non-blocking
+would also affect every other user of the same open file, such as
+standard input on terminals or synchronous writes from ``cli_ui``
+itself. Other streams, like ``io.StringIO``, are written to directly
+with :func:`cli_ui.write_and_flush`.
+"""
+
+import asyncio
+import concurrent.futures
+import sys
+import threading
+import time
+import weakref
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import cli_ui
+from cli_ui import CONFIG, FileObj, Token
+
+# id(fileobj) -> (fileobj, beginning of the current line)
+_Lines = Dict[int, Tuple[FileObj, List[str]]]
+
+# task -> lines being written by the task
+_PARTIAL_LINES: "weakref.WeakKeyDictionary[asyncio.Task[Any], _Lines]" = (
+    weakref.WeakKeyDictionary()
+)
+
+# Writes to file descriptors, in order
+_WRITER_EXECUTOR: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+
+def _get_writer_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _WRITER_EXECUTOR
+    if _WRITER_EXECUTOR is None:
+        _WRITER_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="cli_ui-writer"
+        )
+    return _WRITER_EXECUTOR
+
+
+def _has_file_descriptor(fileobj: FileObj) -> bool:
+    try:
+        fileobj.fileno()
+    except (AttributeError, OSError, ValueError):
+        # io.UnsupportedOperation is a subclass of both
+        return False
+    return True
+
+
+async def write(fileobj: FileObj, to_write: str) -> None:
+    """Write a string to the given stream without blocking the event loop"""
+    if not _has_file_descriptor(fileobj):
+        cli_ui.write_and_flush(fileobj, to_write)
+        return
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(
+        _get_writer_executor(), cli_ui.write_and_flush, fileobj, to_write
+    )
+
+
+async def close() -> None:
+    """Write the lines left incomplete by tasks.
+
+    Call this before the event loop stops.
+    """
+    for task_lines in list(_PARTIAL_LINES.values()):
+        for fileobj, parts in list(task_lines.values()):
+            await write(fileobj, "".join(parts))
+    _PARTIAL_LINES.clear()
+
+
+async def message(
+    *tokens: Token,
+    end: str = "\n",
+    sep: str = " ",
+    fileobj: Optional[FileObj] = None,
+    update_title: bool = False,
+    fields: Optional[Dict[str, Any]] = None,
+) -> None:
+    """Awaitable version of :func:`cli_ui.message`"""
+    if fileobj is None:
+        fileobj = sys.stdout
+    stats = cli_ui._STATS
+    if stats is not None:
+        start = time.perf_counter_ns()
+    to_write: Optional[str]
+    if CONFIG["format"] == "jsonl":
+        task = asyncio.current_task()
+        owner = id(task) if task else threading.get_ident()
+        to_write = cli_ui._jsonl_line(tokens, end, sep, fileobj, fields, owner)
+        complete = True
+    else:
+        to_write = cli_ui._message_string(tokens, end, sep, fileobj, update_title)
+        complete = "\n" in end or "\r" in end
+    if stats is not None:
+        stats.add_message(cli_ui._level_of(tokens), time.perf_counter_ns() - start)
+    if to_write is not None:
+        await _emit(fileobj, to_write, complete=complete)
+
+
+async def _emit(fileobj: FileObj, to_write: str, *, complete: bool) -> None:
+    # Like cli_ui._emit(), but keep lines from concurrent tasks apart
+    task = asyncio.current_task()
+    if task is None:
+        await write(fileobj, to_write)
+        return
+    task_lines = _PARTIAL_LINES.setdefault(task, {})
+    held = task_lines.get(id(fileobj))
+    if not complete:
+        if held is None:
+            held = (fileobj, [])
+            task_lines[id(fileobj)] = held
+        held[1].append(to_write)
+        return
+    if held:
+        del task_lines[id(fileobj)]
+        to_write = "".join(held[1]) + to_write
+    await write(fileobj, to_write)
+
+
+async def error(*tokens: Token, **kwargs: Any) -> None:
+    """Awaitable version of :func:`cli_ui.error`"""
+    if CONFIG["error_limit"] is not None:
+        if not cli_ui._FLOOD_CONTROL.allow("error", sys._getframe(1)):
+            return
+    kwargs["fileobj"] = sys.stderr
+    await message(cli_ui._ERROR_TEMPLATE, *tokens, **kwargs)
+
+
+async def warning(*tokens: Token, **kwargs: Any) -> None:
+    """Awaitable version of :func:`cli_ui.warning`"""
+    if CONFIG["warning_limit"] is not None:
+        if not cli_ui._FLOOD_CONTROL.allow("warning", sys._getframe(1)):
+            return
+    kwargs["fileobj"] = sys.stderr
+    await message(cli_ui._WARNING_TEMPLATE, *tokens, **kwargs)
+
+
+async def info(*tokens: Token, **kwargs: Any) -> None:
+    """Awaitable version of :func:`cli_ui.info`"""
+    if CONFIG["quiet"]:
+        return
+    await message(*tokens, **kwargs)
+
+
+async def info_1(*tokens: Token, **kwargs: Any) -> None:
+    """Awaitable version of :func:`cli_ui.info_1`"""
+    if CONFIG["quiet"]:
+        return
+    await message(cli_ui._INFO_1_TEMPLATE, *tokens, **kwargs)
+
+
+async def info_2(*tokens: Token, **kwargs: Any) -> None:
+    """Awaitable version of :func:`cli_ui.info_2`"""
+    if CONFIG["quiet"]:
+        return
+    await message(cli_ui._INFO_2_TEMPLATE, *tokens, **kwargs)
+
+
+async def info_3(*tokens: Token, **kwargs: Any) -> None:
+    """Awaitable version of :func:`cli_ui.info_3`"""
+    if CONFIG["quiet"]:
+        return
+    await message(cli_ui._INFO_3_TEMPLATE, *tokens, **kwargs)
+
+
+async def debug(*tokens: Token, **kwargs: Any) -> None:
+    """Awaitable version of :func:`cli_ui.debug`"""
+    if not CONFIG["verbose"] or CONFIG["record"]:
+        return
+    await message(cli_ui._DEBUG_TEMPLATE, *tokens, **kwargs)
+
+
+async def info_table(
+    data: Any,
+    *,
+    headers: Union[str, Sequence[str]] = (),
+    fileobj: Optional[FileObj] = None,
+) -> None:
+    """Awaitable version of :func:`cli_ui.info_table`"""
+    if fileobj is None:
+        fileobj = sys.stdout
+    if CONFIG["format"] == "jsonl":
+        stream = cli_ui._stream_name(fileobj)
+        for records in cli_ui._jsonl_rows(data, headers, stream):
+            await _emit(fileobj, records, complete=True)
+        return
+    await _emit(fileobj, cli_ui._table_string(data, headers, fileobj), complete=True)
@@ -0,0 +1,221 @@
+"""Forward messages from worker processes to the parent process.
+
+In worker processes, messages sent to ``sys.stdout`` and ``sys.stderr``
+are not written directly. They are sent over a queue to a thread in the
+parent process, which writes them using the parent's settings: colors,
+quiet mode, time stamps and recording. Lines are never mixed, even when
+workers build them with several calls.
+
+Pass the result of :func:`pool_options` to the pool::
+
+    >>> with ProcessPoolExecutor(max_workers=4, **cli_ui.mp.pool_options()) as pool:
+    ...     pool.map(build, targets)
+    >>> cli_ui.mp.stop()
+"""
+
+import atexit
+import multiprocessing
+import os
+import sys
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import cli_ui
+from cli_ui import CONFIG, FileObj, Token
+
+# (pid, stream, level, colored text, plain text, complete)
+# level is None for raw writes, which are not subject to the quiet mode
+# and do not get a time stamp
+_Item = Tuple[int, str, Optional[str], str, str, bool]
+
+# Maximum number of messages written at once
+_BATCH_SIZE = 256
+
+
+class _Listener:
+    """Write the messages sent by the worker processes"""
+
+    def __init__(self, context: Any):
+        self.queue = context.SimpleQueue()
+        # (pid, stream) -> beginning of the current line
+        self.partial_lines: Dict[Tuple[int, str], List[str]] = {}
+        self.thread = threading.Thread(
+            target=self._run, name="cli_ui-workers", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Write the messages already sent, then stop the thread"""
+        self.queue.put(None)
+        self.thread.join()
+        self.queue.close()
+        cli_ui.flush()
+
+    def _run(self) -> None:
+        done = False
+        while not done:
+            batch = []
+            item = self.queue.get()
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= _BATCH_SIZE or self.queue.empty():
+                    break
+                item = self.queue.get()
+            done = item is None
+            try:
+                self._write(batch)
+            except Exception:
+                sys.excepthook(*sys.exc_info())
+        for (_, stream), parts in self.partial_lines.items():
+            cli_ui.write_and_flush(_get_stream(stream), "".join(parts))
+        self.partial_lines.clear()
+
+    def _write(self, batch: Sequence[_Item]) -> None:
+        # Consecutive messages for the same stream are written at once
+        chunks: List[str] = []
+        chunks_stream = ""
+        for pid, stream, level, colored, plain, complete in batch:
+            text = self._render(stream, level, colored, plain)
+            if not text:
+                continue
+            key = (pid, stream)
+            if not complete:
+                self.partial_lines.setdefault(key, []).append(text)
+                continue
+            held = self.partial_lines.pop(key, None)
+            if held:
+                text = "".join(held) + text
+            if stream != chunks_stream and chunks:
+                cli_ui.write_and_flush(_get_stream(chunks_stream), "".join(chunks))
+                chunks = []
+            chunks_stream = stream
+            chunks.append(text)
+        if chunks:
+            cli_ui.write_and_flush(_get_stream(chunks_stream), "".join(chunks))
+
+    def _render(
+        self, stream: str, level: Optional[str], colored: str, plain: str
+    ) -> str:
+        if level is None:
+            return colored
+        if level == "info" and CONFIG["quiet"]:
+            return ""
+        if CONFIG["record"]:
+            cli_ui._get_recorder().record(plain, level=level, stream=stream)
+        fileobj = _get_stream(stream)
+        text = colored if cli_ui.colors_enabled(fileobj) else plain
+        return cli_ui._timestamp_prefix() + text
+
+
+_LISTENER: Optional[_Listener] = None
+_LISTENER_LOCK = threading.Lock()
+
+
+def _get_stream(name: str) -> FileObj:
+    return sys.stderr if name == "stderr" else sys.stdout
+
+
+def _forwarded_name(fileobj: FileObj) -> Optional[str]:
+    if fileobj is sys.stdout or fileobj is sys.__stdout__:
+        return "stdout"
+    if fileobj is cli_ui._DEFAULT_STDOUT:
+        return "stdout"
+    if fileobj is sys.stderr or fileobj is sys.__stderr__:
+        return "stderr"
+    return None
+
+
+class _Forwarder:
+    """Send messages to the parent process, from a worker process"""
+
+    def __init__(self, queue: Any):
+        self.queue = queue
+        self.pid = os.getpid()
+
+    def message(
+        self, tokens: Sequence[Token], end: str, sep: str, fileobj: FileObj
+    ) -> bool:
+        stream = _forwarded_name(fileobj)
+        if stream is None:
+            return False
+        rendered = cli_ui.RenderedTokens(tokens, end=end, sep=sep)
+        colored, plain = rendered.both()
+        level = cli_ui._level_of(tokens)
+        complete = "\n" in end or "\r" in end
+        self.queue.put((self.pid, stream, level, colored, plain, complete))
+        return True
+
+    def write(self, fileobj: FileObj, to_write: str) -> bool:
+        stream = _forwarded_name(fileobj)
+        if stream is None:
+            return False
+        complete = to_write.endswith(("\n", "\r"))
+        self.queue.put((self.pid, stream, None, to_write, to_write, complete))
+        return True
+
+
+def pool_options(context: Any = None) -> Dict[str, Any]:
+    """Start forwarding messages from worker processes, and return
+    the ``initializer`` and ``initargs`` keyword arguments to use
+    when creating a :class:`concurrent.futures.ProcessPoolExecutor`
+    or a :class:`multiprocessing.pool.Pool`.
+
+    :param context: the multiprocessing context used by the pool, if any
+    """
+    return {"initializer": init_worker, "initargs": init_args(context)}
+
+
+def init_args(context: Any = None) -> Tuple[Any, ...]:
+    """Start forwarding messages from worker processes, and return
+    the arguments to pass to :func:`init_worker`
+    """
+    global _LISTENER
+    with _LISTENER_LOCK:
+        if _LISTENER is None:
+            if context is None:
+                context = multiprocessing.get_context()
+            _LISTENER = _Listener(context)
+    config = dict(CONFIG)
+    # Workers send both flavors of messages, but raw writes such as
+    # tables are rendered by the workers with the parent's choice
+    config["color"] = "always" if cli_ui.colors_enabled(sys.stdout) else "never"
+    return (_LISTENER.queue, config)
+
+
+def init_worker(queue: Any, config: Dict[str, Any]) -> None:
+    """Initialize a worker process, so that it sends its messages
+    to the parent process
+    """
+    CONFIG.update(config)
+    # Those are taken care of by the parent
+    CONFIG["timestamp"] = False
+    CONFIG["title"] = "never"
+    CONFIG["record"] = False
+    CONFIG["background"] = False
+    # State inherited from the parent when the worker is forked
+    global _LISTENER
+    _LISTENER = None
+    cli_ui._BACKGROUND_WRITER = None
+    cli_ui._PARTIAL_LINES.clear()
+    cli_ui._OPEN_LINES.clear()
+    cli_ui._CAPABILITIES.clear()
+    cli_ui._FORWARDER = _Forwarder(queue)
+
+
+def stop() -> None:
+    """Write the messages sent by the worker processes so far,
+    and stop forwarding.
+
+    Call this after the pool is shut down. It is also called
+    when the interpreter exits.
+    """
+    global _LISTENER
+    with _LISTENER_LOCK:
+        if _LISTENER is None:
+            return
+        listener = _LISTENER
+        _LISTENER = None
+    listener.stop()
+
+
+atexit.register(stop)
@@ -0,0 +1,158 @@
+import asyncio
+import io
+import json
+import os
+
+import pytest
+
+import cli_ui
+from cli_ui import aio
+from cli_ui.tests.conftest import MessageRecorder
+
+
+def test_info_falls_back_on_regular_streams() -> None:
+    stream = io.StringIO()
+
+    async def main() -> None:
+        await aio.info_1("foo", fileobj=stream)
+        await aio.info_table([[("bar",), ("baz",)]], fileobj=stream)
+
+    asyncio.run(main())
+    assert stream.getvalue() == ":: foo\n---  ---\nbar  baz\n---  ---\n"
+
+
+def test_info_through_a_pipe() -> None:
+    read_fd, write_fd = os.pipe()
+    with os.fdopen(write_fd, "w") as stream:
+
+        async def main() -> None:
+            await asyncio.gather(
+                *(aio.info("task", i, fileobj=stream) for i in range(10))
+            )
+            await aio.close()
+
+        asyncio.run(main())
+    with os.fdopen(read_fd) as reader:
+        lines = reader.read().splitlines()
+    assert sorted(lines) == sorted(f"task {i}" for i in range(10))
+
+
+def test_stats_through_a_pipe() -> None:
+    read_fd, write_fd = os.pipe()
+    cli_ui.setup(stats=True)
+    try:
+        with os.fdopen(write_fd, "w", encoding="ascii") as stream:
+
+            async def main() -> None:
+                for i in range(4):
+                    await aio.info("task", i, fileobj=stream)
+                await aio.info("caf\u00e9", fileobj=stream)
+                await aio.close()
+
+            asyncio.run(main())
+        stats = cli_ui.stats()
+    finally:
+        cli_ui.setup()
+    with os.fdopen(read_fd, "rb") as reader:
+        written = reader.read()
+    assert written.endswith(b"cafe\n")
+    assert stats is not None
+    assert stats["messages"]["info"] == 5
+    assert sum(stats["bytes"].values()) == len(written)
+    assert stats["write_time"]["count"] == 5
+    assert stats["unicode_fallbacks"] == 1
+
+
+@pytest.mark.skipif(os.name == "nt", reason="no pseudo-terminals on Windows")
+def test_terminals_stay_blocking() -> None:
+    master_fd, slave_fd = os.openpty()
+    with os.fdopen(slave_fd, "w") as stream:
+
+        async def main() -> None:
+            await aio.info("hello", fileobj=stream)
+
+        asyncio.run(main())
+        # stdin usually shares the open file description with the terminal
+        assert os.get_blocking(slave_fd)
+    assert os.read(master_fd, 1024).startswith(b"hello")
+    os.close(master_fd)
+
+
+@pytest.mark.skipif(os.name == "nt", reason="no os.get_blocking() on Windows")
+def test_pipes_stay_blocking() -> None:
+    read_fd, write_fd = os.pipe()
+    with os.fdopen(write_fd, "w") as stream:
+
+        async def main() -> None:
+            await aio.info("hello", fileobj=stream)
+
+        asyncio.run(main())
+        # Synchronous writes to a non-blocking pipe could lose data
+        assert os.get_blocking(write_fd)
+    with os.fdopen(read_fd) as reader:
+        assert reader.read() == "hello\n"
+
+
+def test_lines_from_tasks_are_not_mixed() -> None:
+    stream = io.StringIO()
+
+    async def count(name: str) -> None:
+        for i in range(3):
+            await aio.info(name, end=" ", fileobj=stream)
+            await asyncio.sleep(0)
+            await aio.info(i, fileobj=stream)
+
+    async def main() -> None:
+        await asyncio.gather(count("up"), count("down"))
+
+    asyncio.run(main())
+    lines = stream.getvalue().splitlines()
+    assert sorted(lines) == sorted(
+        f"{name} {i}" for name in ("up", "down") for i in range(3)
+    )
+
+
+def test_error_is_recorded(message_recorder: MessageRecorder) -> None:
+    asyncio.run(aio.error("something bad"))
+    assert message_recorder.find("Error: something bad")
+
+
+def test_quiet(message_recorder: MessageRecorder) -> None:
+    cli_ui.setup(quiet=True)
+    try:
+        asyncio.run(aio.info("hidden"))
+    finally:
+        cli_ui.setup()
+    assert not message_recorder.find("hidden")
+
+
+def test_flood_control(message_recorder: MessageRecorder) -> None:
+    async def main() -> None:
+        for i in range(5):
+            await aio.warning("slow", i)
+
+    cli_ui.setup(warning_limit=1)
+    try:
+        asyncio.run(main())
+    finally:
+        cli_ui.setup()
+    assert message_recorder.count("slow") == 1
+    assert message_recorder.find("suppressed 4 similar warnings")
+
+
+def test_jsonl() -> None:
+    stream = io.StringIO()
+
+    async def main() -> None:
+        await aio.info("a", end=" ", fileobj=stream)
+        await aio.info("b", fileobj=stream)
+        await aio.info_table([[("c",)]], headers=["name"], fileobj=stream)
+
+    cli_ui.setup(format="jsonl")
+    try:
+        asyncio.run(main())
+    finally:
+        cli_ui.setup()
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [r["message"] for r in records] == ["a b", "c"]
+    assert records[1]["row"] == {"name": "c"}
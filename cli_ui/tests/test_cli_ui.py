@@ -1,8 +1,16 @@
 import datetime
 import io
+import json
 import os
+import pstats
 import re
-from typing import Iterator
+import signal
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, Iterator, List, Tuple
 from unittest import mock
 
 import colorama
@@ -35,6 +43,16 @@ class DumbTTY(io.StringIO):
         return False
 
 
+class CountingFlushes(DumbTTY):
+    def __init__(self) -> None:
+        super().__init__()
+        self.flushes = 0
+
+    def flush(self) -> None:
+        self.flushes += 1
+        super().flush()
+
+
 @pytest.fixture
 def smart_tty() -> SmartTTY:
     return SmartTTY()
@@ -59,6 +77,17 @@ def always_color() -> Iterator[None]:
     cli_ui.setup(color="auto")
 
 
+@pytest.fixture
+def jsonl_format() -> Iterator[None]:
+    cli_ui.setup(format="jsonl", color="always", verbose=True)
+    yield
+    cli_ui.setup()
+
+
+def read_records(stream: io.StringIO) -> List[Any]:
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
 def test_info_with_colors(always_color: None, smart_tty: io.StringIO) -> None:
     # fmt: off
     cli_ui.info(
@@ -108,16 +137,266 @@ def test_info_characters(always_color: None, smart_tty: SmartTTY) -> None:
         "Doing stuff", cli_ui.ellipsis, "success", cli_ui.check, fileobj=smart_tty
     )
     actual = smart_tty.getvalue()
-    if os.name == "nt":
-        success = "ok"
-        ellipsis = "..."
-    else:
-        success = "✓"
-        ellipsis = "…"
-    expected = f"Doing stuff {RESET_ALL}{RESET_ALL}{ellipsis} {RESET_ALL}success {RESET_ALL}{GREEN}{success} {RESET_ALL}\n{RESET_ALL}"
+    expected = f"Doing stuff {RESET_ALL}{RESET_ALL}… {RESET_ALL}success {RESET_ALL}{GREEN}✓ {RESET_ALL}\n{RESET_ALL}"
     assert actual == expected
 
 
+@pytest.mark.parametrize(
+    "encoding, expected",
+    [
+        ("utf-8", "café ✓ 東京 … \n"),
+        ("latin-1", "café ok Dong Jing  ... \n"),
+        ("ascii", "cafe ok Dong Jing  ... \n"),
+    ],
+)
+def test_characters_depend_on_the_stream(encoding: str, expected: str) -> None:
+    stream = io.TextIOWrapper(io.BytesIO(), encoding=encoding)
+    cli_ui.info("café", cli_ui.check, "東京", cli_ui.ellipsis, fileobj=stream)
+    stream.flush()
+    assert stream.buffer.getvalue().decode(encoding) == expected
+
+
+def test_no_flush_for_each_message_when_buffering() -> None:
+    stream = CountingFlushes()
+    cli_ui.setup(buffering="always", buffer_size=20, flush_interval=60)
+    try:
+        cli_ui.info("one", fileobj=stream)
+        cli_ui.info("two", fileobj=stream)
+        assert stream.flushes == 0
+        cli_ui.info("this is long enough", fileobj=stream)
+        assert stream.flushes == 1
+        cli_ui.info("three", fileobj=stream)
+        cli_ui.flush()
+        assert stream.flushes == 2
+        assert stream.getvalue() == "one\ntwo\nthis is long enough\nthree\n"
+    finally:
+        cli_ui.setup()
+
+
+def test_flush_each_message_on_terminals(smart_tty: SmartTTY) -> None:
+    with mock.patch.object(smart_tty, "flush") as flush:
+        cli_ui.info("one", fileobj=smart_tty)
+        cli_ui.info("two", fileobj=smart_tty)
+        assert flush.call_count == 2
+
+
+def test_flush_each_message_on_terminals_when_buffering(smart_tty: SmartTTY) -> None:
+    cli_ui.setup(buffering="always", flush_interval=60)
+    try:
+        with mock.patch.object(smart_tty, "flush") as flush:
+            cli_ui.dot(fileobj=smart_tty)
+            cli_ui.dot(fileobj=smart_tty)
+            assert flush.call_count == 2
+    finally:
+        cli_ui.setup()
+
+
+def test_flush_each_message_by_default() -> None:
+    # The output of a subprocess must not come before earlier messages
+    stream = CountingFlushes()
+    cli_ui.info("one", fileobj=stream)
+    cli_ui.info("two", fileobj=stream)
+    assert stream.flushes == 2
+
+
+def test_flush_when_idle() -> None:
+    stream = CountingFlushes()
+    cli_ui.setup(buffering="always", flush_interval=0.05)
+    try:
+        cli_ui.info("pending", fileobj=stream)
+        assert stream.flushes == 0
+        deadline = time.monotonic() + 5
+        while not stream.flushes and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert stream.flushes == 1
+    finally:
+        cli_ui.setup()
+
+
+def test_flush_before_prompt() -> None:
+    stream = CountingFlushes()
+    cli_ui.setup(buffering="always", flush_interval=60)
+    try:
+        cli_ui.info("pending", fileobj=stream)
+        with mock.patch("builtins.input") as m:
+            m.side_effect = ["foo"]
+            cli_ui.read_input()
+        assert stream.flushes == 1
+    finally:
+        cli_ui.setup()
+
+
+def test_background_writer_keeps_order(dumb_tty: DumbTTY) -> None:
+    cli_ui.setup(background=True)
+    try:
+        for i in range(100):
+            cli_ui.info(i, fileobj=dumb_tty)
+        cli_ui.flush()
+        assert dumb_tty.getvalue() == "".join(f"{i}\n" for i in range(100))
+    finally:
+        cli_ui.setup()
+
+
+def test_background_writer_drop_new_messages() -> None:
+    class SlowTTY(DumbTTY):
+        def __init__(self) -> None:
+            super().__init__()
+            self.unblock = threading.Event()
+
+        def write(self, s: str) -> int:
+            self.unblock.wait()
+            return super().write(s)
+
+    stream = SlowTTY()
+    cli_ui.setup(background=True, queue_size=2, backpressure="drop")
+    try:
+        before = cli_ui.dropped_messages()
+        for i in range(10):
+            cli_ui.info(i, fileobj=stream)
+        # one being written, two waiting in the queue
+        assert cli_ui.dropped_messages() - before >= 7
+        stream.unblock.set()
+        cli_ui.flush()
+        assert stream.getvalue().startswith("0\n")
+    finally:
+        stream.unblock.set()
+        cli_ui.setup()
+
+
+def test_lines_from_threads_are_not_mixed(dumb_tty: DumbTTY) -> None:
+    def worker(name: str) -> None:
+        for i in range(200):
+            cli_ui.info(name, end=" ", fileobj=dumb_tty)
+            cli_ui.info("says", end=" ", fileobj=dumb_tty)
+            cli_ui.info(i, fileobj=dumb_tty)
+
+    names = [f"worker-{i}" for i in range(16)]
+    threads = [threading.Thread(target=worker, args=(name,)) for name in names]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    lines = dumb_tty.getvalue().splitlines()
+    assert len(lines) == 16 * 200
+    for line in lines:
+        assert re.fullmatch(r"worker-\d+ says \d+", line)
+
+
+def test_dots_show_up_with_idle_threads(dumb_tty: DumbTTY) -> None:
+    stop = threading.Event()
+    idle = threading.Thread(target=stop.wait, daemon=True)
+    idle.start()
+    try:
+        cli_ui.dot(fileobj=dumb_tty)
+        assert dumb_tty.getvalue() == "."
+        cli_ui.dot(fileobj=dumb_tty)
+        assert dumb_tty.getvalue() == ".."
+        cli_ui.dot(last=True, fileobj=dumb_tty)
+        assert dumb_tty.getvalue() == "...\n"
+    finally:
+        stop.set()
+        idle.join()
+
+
+def test_lines_wait_for_an_incomplete_line(dumb_tty: DumbTTY) -> None:
+    def other(text: str) -> None:
+        thread = threading.Thread(
+            target=cli_ui.info, args=(text,), kwargs={"fileobj": dumb_tty}
+        )
+        thread.start()
+        thread.join()
+
+    cli_ui.info("Working", end="", fileobj=dumb_tty)
+    other("from another thread")
+    cli_ui.info(" done", fileobj=dumb_tty)
+    assert dumb_tty.getvalue() == "Working done\nfrom another thread\n"
+
+    # ... but not forever
+    with mock.patch("cli_ui._MAX_LINE_DELAY", 0):
+        cli_ui.info("Working", end="", fileobj=dumb_tty)
+        other("from another thread")
+        cli_ui.info(" done", fileobj=dumb_tty)
+    assert dumb_tty.getvalue().splitlines()[2:] == [
+        "Working",
+        "from another thread",
+        " done",
+    ]
+
+
+def test_lines_do_not_wait_for_a_silent_thread(dumb_tty: DumbTTY) -> None:
+    done = threading.Event()
+
+    def work() -> None:
+        cli_ui.info("Working", end="", fileobj=dumb_tty)
+        done.wait()
+        cli_ui.info(" done", fileobj=dumb_tty)
+
+    with mock.patch("cli_ui._MAX_LINE_DELAY", 0.05):
+        thread = threading.Thread(target=work)
+        thread.start()
+        try:
+            while not dumb_tty.getvalue():
+                time.sleep(0.01)
+            cli_ui.info("from the main thread", fileobj=dumb_tty)
+            time.sleep(0.3)
+            assert dumb_tty.getvalue() == "Working\nfrom the main thread\n"
+        finally:
+            done.set()
+            thread.join()
+    assert dumb_tty.getvalue().endswith(" done\n")
+
+
+def test_isatty_is_called_once_per_stream(smart_tty: SmartTTY) -> None:
+    with mock.patch.object(smart_tty, "isatty", return_value=True) as isatty:
+        for _ in range(10):
+            cli_ui.info("foo", fileobj=smart_tty)
+        assert isatty.call_count == 1
+        cli_ui.setup()
+        cli_ui.info("foo", fileobj=smart_tty)
+        assert isatty.call_count == 2
+
+
+def test_title_can_be_disabled(always_color: None, smart_tty: SmartTTY) -> None:
+    cli_ui.setup(color="always", title="never")
+    cli_ui.info("Something", fileobj=smart_tty, update_title=True)
+    assert smart_tty.getvalue() == f"Something\n{RESET_ALL}"
+
+
+def test_rendered_tokens_match_process_tokens() -> None:
+    tokens = [cli_ui.red, "this is red", cli_ui.reset, cli_ui.check, "done"]
+    expected = cli_ui.process_tokens(tokens)
+    rendered = cli_ui.RenderedTokens(tokens)
+    assert rendered.without_color == expected[1]
+    assert rendered.with_color == expected[0]
+    assert tuple(cli_ui.RenderedTokens(tokens)) == expected
+
+
+def test_rendered_tokens_are_lazy() -> None:
+    rendered = cli_ui.RenderedTokens([cli_ui.red, "foo"], end="")
+    assert rendered.without_color == "foo"
+    assert rendered._with_color is None
+
+
+@pytest.mark.parametrize(
+    "rest", [(), ("foo",), ("foo", cli_ui.red, "bar"), (cli_ui.reset,), (cli_ui.check,)]
+)
+@pytest.mark.parametrize("sep", [" ", "", "--"])
+def test_template_renders_like_plain_tokens(rest: Tuple[Any, ...], sep: str) -> None:
+    head = (cli_ui.bold, cli_ui.blue, "::", cli_ui.reset, "Error:")
+    template = cli_ui.template(*head)
+    expected = cli_ui.process_tokens(head + rest, sep=sep)
+    actual = cli_ui.process_tokens((template,) + rest, sep=sep)
+    assert actual == expected
+    assert cli_ui.RenderedTokens((template,) + rest, sep=sep).with_color == expected[0]
+
+
+def test_error_uses_template(smart_tty: SmartTTY, always_color: None) -> None:
+    with mock.patch("sys.stderr", smart_tty):
+        cli_ui.error("oops")
+    assert smart_tty.getvalue() == f"{BRIGHT}{RED}Error: oops\n{RESET_ALL}"
+
+
 def test_timestamp(dumb_tty: DumbTTY, toggle_timestamp: None) -> None:
     cli_ui.info("message", fileobj=dumb_tty)
     actual = dumb_tty.getvalue()
@@ -126,6 +405,34 @@ def test_timestamp(dumb_tty: DumbTTY, toggle_timestamp: None) -> None:
     assert datetime.datetime.strptime(match.groups()[0], "%Y-%m-%d %H:%M:%S")
 
 
+def test_timestamp_with_milliseconds(dumb_tty: DumbTTY) -> None:
+    cli_ui.setup(timestamp=True, timestamp_format="milliseconds")
+    try:
+        cli_ui.info("message", fileobj=dumb_tty)
+    finally:
+        cli_ui.setup()
+    match = re.match(r"\[(.*)\] message", dumb_tty.getvalue())
+    assert match
+    assert datetime.datetime.strptime(match.groups()[0], "%Y-%m-%d %H:%M:%S.%f")
+
+
+def test_relative_timestamp(dumb_tty: DumbTTY) -> None:
+    cli_ui.setup(timestamp=True, timestamp_format="relative")
+    try:
+        cli_ui.info("message", fileobj=dumb_tty)
+    finally:
+        cli_ui.setup()
+    assert re.match(r"\[\+\d+\.\d{3}s\] message", dumb_tty.getvalue())
+
+
+def test_timestamp_is_formatted_once_per_second(toggle_timestamp: None) -> None:
+    with mock.patch("time.strftime", wraps=time.strftime) as strftime:
+        with mock.patch("time.time", return_value=1_000_000.5):
+            for _ in range(10):
+                cli_ui.process_tokens(["foo"])
+        assert strftime.call_count == 1
+
+
 def test_table_with_lists_no_color(dumb_tty: DumbTTY) -> None:
     headers = ["name", "score"]
     data = [
@@ -206,6 +513,63 @@ def test_table_with_lists_with_color(always_color: None, smart_tty: SmartTTY) ->
     assert actual == expected
 
 
+@pytest.mark.parametrize(
+    "headers, data",
+    [
+        (
+            ["name", "score"],
+            [
+                [(cli_ui.bold, "John"), (cli_ui.green, 10)],
+                [(cli_ui.bold, "Jane"), (5,)],
+            ],
+        ),
+        (["x", "y"], [[("a",), ("1.5",)], [("c",), ("10",)], [("d",), ("",)]]),
+        (
+            ["x", "y"],
+            [[("a",), (cli_ui.green, "1.50")], [("b",), ("10",)], [("c",), ("1e5",)]],
+        ),
+        ((), [[("a",), ("bb",)], [("c",), ("d",)]]),
+        (["name", "n"], []),
+        (["x", "y"], [[("a",), ("1,000",)], [("b",), ("20",)]]),
+        (["x", "y"], [[("a",), ("1e20",)], [("b",), ("2",)]]),
+        (["x", "y"], [[("a",), ("nan",)], [("b",), ("1e999",)]]),
+        (["h", "longheader"], [[("a",)], [("c",), ("x",)]]),
+    ],
+)
+@pytest.mark.parametrize("color", ["never", "always"])
+def test_table_stream_looks_like_table(
+    headers: List[str], data: List[List[Tuple[Any, ...]]], color: str
+) -> None:
+    cli_ui.setup(color=color)
+    try:
+        expected = io.StringIO()
+        cli_ui.info_table(data, headers=headers, fileobj=expected)
+        actual = io.StringIO()
+        cli_ui.info_table_stream(iter(data), headers=headers, fileobj=actual)
+    finally:
+        cli_ui.setup()
+    assert actual.getvalue() == expected.getvalue()
+
+
+def test_table_stream_after_sample(dumb_tty: DumbTTY) -> None:
+    rows = ([(f"item-{i}",), (i,)] for i in range(5))
+    cli_ui.info_table_stream(
+        rows, headers=["name", "value"], sample_size=2, fileobj=dumb_tty
+    )
+    # fmt: off
+    expected = (
+        "name      value\n"
+        "------  -------\n"
+        "item-0        0\n"
+        "item-1        1\n"
+        "item-2        2\n"
+        "item-3        3\n"
+        "item-4        4\n"
+    )
+    # fmt: on
+    assert dumb_tty.getvalue() == expected
+
+
 def test_record_message(message_recorder: MessageRecorder) -> None:
     cli_ui.info_1("This is foo")
     assert message_recorder.find("foo")
@@ -288,6 +652,373 @@ def test_ask_yes_no_wrong_input() -> None:
         assert m.call_count == 2
 
 
+def test_recorder_levels_and_streams(message_recorder: MessageRecorder) -> None:
+    cli_ui.info_1("Starting")
+    cli_ui.warning("Disk almost full")
+    cli_ui.error("Disk full")
+    assert message_recorder.find("Disk", level="error") == "Error: Disk full\n"
+    assert message_recorder.find("Disk", stream="stdout") is None
+    assert message_recorder.count(stream="stderr") == 2
+    assert message_recorder.count(level="info") == 1
+
+
+def test_recorder_queries(message_recorder: MessageRecorder) -> None:
+    for i in range(10):
+        cli_ui.info("file", i, "(1.2 MB)")
+    assert message_recorder.count("(1.2 MB)") == 10
+    assert message_recorder.find_all(r"file [13] ") == [
+        "file 1 (1.2 MB)\n",
+        "file 3 (1.2 MB)\n",
+    ]
+    message_recorder.reset()
+    assert len(message_recorder) == 0
+
+
+def test_recorder_capacity() -> None:
+    recorder = cli_ui.Recorder(capacity=3)
+    recorder.start()
+    try:
+        for i in range(10):
+            cli_ui.info("message", i)
+    finally:
+        recorder.stop()
+    assert len(recorder) == 3
+    assert recorder.find_all("message") == [
+        "message 7\n",
+        "message 8\n",
+        "message 9\n",
+    ]
+
+
+def test_recorder_spill(tmp_path: Path) -> None:
+    spill_path = tmp_path / "messages.jsonl"
+    spill_path.write_text("stale\n")
+    recorder = cli_ui.Recorder(capacity=2, spill_path=str(spill_path))
+    recorder.start()
+    try:
+        for i in range(5):
+            cli_ui.info("message", i)
+        cli_ui.error("oops")
+    finally:
+        recorder.stop()
+    assert recorder.spilled == 4
+    assert len(recorder) == 6
+    assert recorder.find("message 0") == "message 0\n"
+    assert recorder.count("message") == 5
+    assert recorder.find("oops", level="error")
+    recorder.reset()
+    assert not spill_path.exists()
+
+
+def test_recorder_queries_read_the_spill_file_lazily(tmp_path: Path) -> None:
+    recorder = cli_ui.Recorder(capacity=1, spill_path=str(tmp_path / "spill.jsonl"))
+    for i in range(100):
+        recorder.record(f'caf\u00e9 "{i}"', level="warning" if i == 42 else "info")
+    recorder.record("last")
+    with mock.patch("json.loads", wraps=json.loads) as loads:
+        assert recorder.find('caf\u00e9 "42"') == 'caf\u00e9 "42"'
+        assert loads.call_count == 1
+        assert recorder.count(level="warning") == 1
+        assert loads.call_count == 2
+        assert recorder.find("ca.\u00e9 .99") == 'caf\u00e9 "99"'
+    assert [record.text for record in recorder.records()][-2:] == [
+        'caf\u00e9 "99"',
+        "last",
+    ]
+
+
+def test_lazy_tokens_are_not_computed_when_filtered_out(
+    message_recorder: MessageRecorder,
+) -> None:
+    calls = []
+
+    def expensive(name: str) -> str:
+        calls.append(name)
+        return name
+
+    cli_ui.debug("state", cli_ui.lazy(expensive, "debug"))
+    cli_ui.setup(quiet=True)
+    try:
+        for func in (cli_ui.info, cli_ui.info_1, cli_ui.info_2, cli_ui.info_3):
+            func(cli_ui.lazy(expensive, "quiet"))
+        cli_ui.info_section(cli_ui.lazy(expensive, "quiet"))
+        cli_ui.info_count(0, 1, cli_ui.lazy(expensive, "quiet"))
+    finally:
+        cli_ui.setup()
+    assert calls == []
+
+
+def test_info_section_ignores_fields_in_text_mode(dumb_tty: DumbTTY) -> None:
+    cli_ui.info_section("Build", fields={"target": "all"}, fileobj=dumb_tty)
+    assert dumb_tty.getvalue() == "Build\n------\n\n"
+
+
+def test_lazy_tokens_are_computed_once(smart_tty: SmartTTY) -> None:
+    calls = []
+
+    def get_status() -> Any:
+        calls.append(True)
+        return cli_ui.green
+
+    cli_ui.info("status:", cli_ui.lazy(get_status), "x", fileobj=smart_tty)
+    assert calls == [True]
+    assert smart_tty.getvalue() == "status: " + GREEN + "x\n" + RESET_ALL
+
+
+def test_enabled_for() -> None:
+    assert cli_ui.enabled_for("info")
+    assert cli_ui.enabled_for("error")
+    assert not cli_ui.enabled_for("debug")
+    cli_ui.setup(verbose=True, quiet=True)
+    try:
+        assert cli_ui.enabled_for("debug")
+        assert not cli_ui.enabled_for("info")
+        assert cli_ui.enabled_for("warning")
+    finally:
+        cli_ui.setup()
+    with pytest.raises(ValueError):
+        cli_ui.enabled_for("trace")
+
+
+def test_jsonl_messages(jsonl_format: None, smart_tty: SmartTTY) -> None:
+    cli_ui.info_1("Starting", cli_ui.bold, "build", fileobj=smart_tty)
+    cli_ui.debug("state:", {"x": 1}, fileobj=smart_tty)
+    cli_ui.info("one", end=" ", fileobj=smart_tty)
+    cli_ui.info("line", "\u2713", fileobj=smart_tty, fields={"count": 2})
+    records = read_records(smart_tty)
+    assert [(r["level"], r["stream"], r["message"]) for r in records] == [
+        ("info", "SmartTTY", "Starting build"),
+        ("debug", "SmartTTY", "state: {'x': 1}"),
+        ("info", "SmartTTY", "one line \u2713"),
+    ]
+    assert records[2]["fields"] == {"count": 2}
+    assert re.match(r"\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{3}Z$", records[0]["time"])
+
+
+def test_jsonl_errors(jsonl_format: None, capsys: pytest.CaptureFixture[str]) -> None:
+    cli_ui.error("Disk", "full")
+    cli_ui.warning("Disk almost full")
+    cli_ui.flush()
+    records = [json.loads(line) for line in capsys.readouterr().err.splitlines()]
+    assert [(r["level"], r["stream"], r["message"]) for r in records] == [
+        ("error", "stderr", "Disk full"),
+        ("warning", "stderr", "Disk almost full"),
+    ]
+
+
+def test_jsonl_table(jsonl_format: None, smart_tty: SmartTTY) -> None:
+    data = [[(cli_ui.bold, "John"), (cli_ui.green, 10.0)]] * 1500
+    cli_ui.info_table(data, headers=["name", "score"], fileobj=smart_tty)
+    records = read_records(smart_tty)
+    assert len(records) == 1500
+    assert records[0]["row"] == {"name": "John", "score": "10.0"}
+    assert records[0]["message"] == "John 10.0"
+
+
+def test_jsonl_table_stream(jsonl_format: None, smart_tty: SmartTTY) -> None:
+    rows = ([(str(i),), (cli_ui.green, "x")] for i in range(3))
+    cli_ui.info_table_stream(rows, fileobj=smart_tty)
+    assert [r["row"] for r in read_records(smart_tty)] == [
+        ["0", "x"],
+        ["1", "x"],
+        ["2", "x"],
+    ]
+
+
+def test_jsonl_timer(jsonl_format: None) -> None:
+    with mock.patch("cli_ui._emit") as emit:
+        with cli_ui.Timer("stuff"):
+            pass
+    (_, line), _ = emit.call_args
+    record = json.loads(line)
+    assert record["fields"]["timer"] == "stuff"
+    assert record["fields"]["seconds"] >= 0
+
+
+@pytest.fixture
+def reset_timers() -> Iterator[None]:
+    cli_ui.reset_timers()
+    yield
+    cli_ui.reset_timers()
+
+
+def test_timer(reset_timers: None, message_recorder: MessageRecorder) -> None:
+    with cli_ui.Timer("build"):
+        with cli_ui.Timer("compile") as timer:
+            pass
+    assert timer.elapsed >= 0
+    assert message_recorder.find(r"^  compile took 0h 0m 0s \d+ms")
+    assert message_recorder.find(r"^build took 0h 0m 0s \d+ms")
+
+
+def test_timer_nested_spans(reset_timers: None) -> None:
+    with cli_ui.Timer("build", log=False):
+        for _ in range(3):
+            with cli_ui.Timer("compile", log=False):
+                pass
+        with cli_ui.Timer("link", log=False):
+            pass
+    with cli_ui.Timer("compile", log=False):
+        pass
+    spans = cli_ui.timer_report()["spans"]
+    assert [(span["name"], span["count"]) for span in spans] == [
+        ("build", 1),
+        ("compile", 1),
+    ]
+    children = spans[0]["children"]
+    assert [(span["name"], span["count"]) for span in children] == [
+        ("compile", 3),
+        ("link", 1),
+    ]
+    compile_span = children[0]
+    assert compile_span["p50"] <= compile_span["p95"] <= compile_span["total"]
+    assert compile_span["mean"] == pytest.approx(compile_span["total"] / 3)
+
+
+def test_timer_memory_does_not_grow_with_runs(reset_timers: None) -> None:
+    with mock.patch("cli_ui._SPAN_SAMPLE_SIZE", 10):
+        for _ in range(100):
+            with cli_ui.Timer("step", log=False):
+                pass
+    assert len(cli_ui._SPANS[("step",)].sample) == 10
+    (span,) = cli_ui.timer_report()["spans"]
+    assert span["count"] == 100
+    assert span["p50"] <= span["p95"]
+    assert span["mean"] == pytest.approx(span["total"] / 100)
+
+
+def test_timer_decorator_keeps_time_on_exception(reset_timers: None) -> None:
+    @cli_ui.Timer("fail", log=False)
+    def fail() -> None:
+        raise ValueError()
+
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            fail()
+    (span,) = cli_ui.timer_report()["spans"]
+    assert span["count"] == 2
+
+
+def test_timer_report_as_json(reset_timers: None, tmp_path: Path) -> None:
+    with cli_ui.Timer("build", log=False):
+        pass
+    path = tmp_path / "timers.json"
+    report = cli_ui.timer_report(str(path))
+    assert json.loads(path.read_text()) == report
+
+
+def test_info_timers(reset_timers: None, dumb_tty: DumbTTY) -> None:
+    cli_ui.info_timers(fileobj=dumb_tty)
+    assert dumb_tty.getvalue() == ""
+    with cli_ui.Timer("build", log=False):
+        with cli_ui.Timer("compile", log=False):
+            pass
+    cli_ui.info_timers(fileobj=dumb_tty)
+    lines = dumb_tty.getvalue().splitlines()
+    assert lines[0].split() == [
+        "timer",
+        "count",
+        "total",
+        "(s)",
+        "mean",
+        "(s)",
+        "p50",
+        "(s)",
+        "p95",
+        "(s)",
+    ]
+    assert lines[2].startswith("build ")
+    assert lines[3].startswith("  compile ")
+
+
+def allocate() -> List[str]:
+    return [str(i) * 10 for i in range(10_000)]
+
+
+def test_timer_profile(reset_timers: None) -> None:
+    with mock.patch("cli_ui.info_table") as info_table:
+        with cli_ui.Timer("build", log=False, profile=True, top=3):
+            # Already profiled by the outer timer
+            with cli_ui.Timer("allocate", log=False, profile=True):
+                allocate()
+    (rows,), kwargs = info_table.call_args
+    assert kwargs["headers"][0] == "function"
+    assert len(rows) == 3
+    names = [row[0][0] for row in rows]
+    assert any(name.startswith("test_cli_ui.py:") for name in names)
+
+
+def test_timer_memory(reset_timers: None) -> None:
+    with mock.patch("cli_ui.info_table") as info_table:
+        with cli_ui.Timer("build", log=False, memory=True):
+            allocated = allocate()
+    assert allocated
+    (rows,), _ = info_table.call_args
+    (site,), (size,), (blocks,) = rows[0]
+    assert site.startswith("test_cli_ui.py:")
+    assert float(size) > 100
+    assert blocks >= 10_000
+
+
+def test_timer_profile_path(reset_timers: None, tmp_path: Path) -> None:
+    path = tmp_path / "build.prof"
+
+    @cli_ui.Timer("build", log=False, profile_path=str(path))
+    def build() -> None:
+        allocate()
+
+    with mock.patch("cli_ui.info_table") as info_table:
+        build()
+    assert not info_table.called
+    assert pstats.Stats(str(path)).total_calls > 0  # type: ignore[attr-defined]
+
+
+def test_jsonl_does_not_erase_lines(jsonl_format: None, smart_tty: SmartTTY) -> None:
+    cli_ui.info_count(0, 2, "foo", one_line=True, fileobj=smart_tty)
+    (record,) = read_records(smart_tty)
+    assert record["message"] == "* (1/2) foo"
+
+
+@pytest.fixture
+def enable_stats() -> Iterator[None]:
+    cli_ui.setup(stats=True, buffering="never")
+    yield
+    cli_ui.setup()
+
+
+def test_stats_disabled_by_default() -> None:
+    assert cli_ui.stats() is None
+
+
+def test_stats(enable_stats: None, smart_tty: SmartTTY) -> None:
+    cli_ui.info("caf\u00e9", fileobj=smart_tty)
+    cli_ui.info_2("two", fileobj=smart_tty)
+    cli_ui.warning("careful", fileobj=smart_tty)
+    stats = cli_ui.stats(reset=True)
+    assert stats is not None
+    assert stats["messages"] == {"debug": 0, "info": 2, "warning": 1, "error": 0}
+    assert stats["bytes"]["SmartTTY"] == len(smart_tty.getvalue()) + 1
+    assert stats["flushes"] == 3
+    assert stats["unicode_fallbacks"] == 0
+    for histogram in stats["render_time"], stats["write_time"]:
+        assert histogram["count"] == 3
+        assert sum(count for _, count in histogram["buckets"]) == 3
+        assert histogram["buckets"][-1][0] is None
+    stats = cli_ui.stats()
+    assert stats is not None
+    assert stats["messages"]["info"] == 0
+
+
+def test_stats_unicode_fallback(enable_stats: None) -> None:
+    ascii_stream = io.TextIOWrapper(io.BytesIO(), encoding="ascii")
+    cli_ui.info("caf\u00e9", fileobj=ascii_stream)
+    stats = cli_ui.stats()
+    assert stats is not None
+    assert stats["unicode_fallbacks"] == 1
+    assert ascii_stream.buffer.getvalue() == b"cafe\n"
+    assert sum(stats["bytes"].values()) == 5
+
+
 def test_ask_choice() -> None:
     class Fruit:
         def __init__(self, name: str, price: int):
@@ -375,6 +1106,210 @@ def test_select_choices_ctrl_c() -> None:
             cli_ui.select_choices("Select a animal", choices=["cat", "dog", "cow"])
 
 
+def test_ask_choice_does_not_mutate_choices() -> None:
+    choices = ["cow", "cat", "dog"]
+    with mock.patch("builtins.input") as m:
+        m.side_effect = ["1"]
+        res = cli_ui.ask_choice("Select a animal", choices=choices)
+    assert res == "cat"
+    assert choices == ["cow", "cat", "dog"]
+
+
+def test_choices_descriptions_are_computed_once(
+    message_recorder: MessageRecorder,
+) -> None:
+    calls = []
+
+    def func_desc(x: int) -> str:
+        calls.append(x)
+        return "choice %05i" % x
+
+    with mock.patch("builtins.input") as m:
+        m.side_effect = ["3"]
+        res = cli_ui.ask_choice(
+            "Pick one", choices=list(range(1000, 0, -1)), func_desc=func_desc
+        )
+    assert res == 3
+    assert len(calls) == 1000
+
+
+def test_ask_choice_paging(message_recorder: MessageRecorder) -> None:
+    choices = ["host-%03i" % i for i in range(1, 101)]
+    with mock.patch("builtins.input") as m:
+        m.side_effect = ["+", "15"]
+        res = cli_ui.ask_choice("Select a host", choices=choices, page_size=10)
+    assert res == "host-015"
+    assert message_recorder.find("Showing 1-10 of 100")
+    assert message_recorder.find("Showing 11-20 of 100")
+    assert not message_recorder.find("host-021")
+
+
+def test_ask_choice_filter(message_recorder: MessageRecorder) -> None:
+    choices = ["host-%03i" % i for i in range(1, 101)] + ["database"]
+    with mock.patch("builtins.input") as m:
+        m.side_effect = ["base", "101"]
+        res = cli_ui.ask_choice(
+            "Select a host", choices=choices, sort=False, page_size=10
+        )
+    assert res == "database"
+    # Numbers still refer to the whole list
+    assert message_recorder.find(r"101 database")
+    assert message_recorder.find("Showing 1-1 of 1 matching 'base'")
+
+
+def test_ask_choice_filter_narrows_down(message_recorder: MessageRecorder) -> None:
+    choices = ["main", "maint/1.x", "maint/2.x", "feature"]
+    with mock.patch("builtins.input") as m:
+        m.side_effect = ["maint", "maint/2", "3"]
+        cli_ui.ask_choice("Select a branch", choices=choices, page_size=10)
+    assert message_recorder.find("Showing 1-2 of 2 matching 'maint'")
+    assert message_recorder.find("Showing 1-1 of 1 matching 'maint/2'")
+
+
+def test_ask_choice_fuzzy_filter(message_recorder: MessageRecorder) -> None:
+    choices = ["apple", "banana", "orange"]
+    with mock.patch("builtins.input") as m:
+        m.side_effect = ["bananna", ""]
+        cli_ui.ask_choice("Select a fruit", choices=choices, page_size=2)
+    assert message_recorder.find("Showing 1-1 of 1 matching 'bananna'")
+
+
+def test_select_choices_ranges() -> None:
+    choices = ["choice %04i" % i for i in range(1, 1001)]
+    with mock.patch("builtins.input") as m:
+        m.side_effect = ["3-250, 999"]
+        res = cli_ui.select_choices("Select", choices=choices)
+    assert res == choices[2:250] + [choices[998]]
+
+
+@pytest.mark.parametrize("answer", ["0", "3-1001", "5-3"])
+def test_select_choices_invalid_ranges(answer: str) -> None:
+    choices = ["choice %04i" % i for i in range(1, 1001)]
+    with mock.patch("builtins.input") as m:
+        m.side_effect = [answer, ""]
+        res = cli_ui.select_choices("Select", choices=choices)
+    assert res is None
+    assert m.call_count == 2
+
+
+@pytest.mark.skipif(os.name == "nt", reason="lines are erased with spaces on Windows")
+def test_info_count_one_line_on_terminals(
+    always_color: None, smart_tty: SmartTTY
+) -> None:
+    cli_ui.info_count(0, 2, "foo", one_line=True, fileobj=smart_tty)
+    assert smart_tty.getvalue().startswith("\r\x1b[K")
+
+
+def test_erase_last_line_elsewhere(dumb_tty: DumbTTY) -> None:
+    with mock.patch.dict(os.environ, {"COLUMNS": "10"}):
+        cli_ui.erase_last_line(dumb_tty)
+    assert dumb_tty.getvalue() == " " * 10 + "\r"
+
+
+@pytest.mark.skipif(os.name == "nt", reason="no SIGWINCH on Windows")
+def test_terminal_width_is_read_once_elsewhere(dumb_tty: DumbTTY) -> None:
+    handler = signal.getsignal(signal.SIGWINCH)
+    with mock.patch.dict(os.environ, {"COLUMNS": "10"}):
+        cli_ui.erase_last_line(dumb_tty)
+        os.environ["COLUMNS"] = "20"
+        cli_ui.erase_last_line(dumb_tty)
+    assert dumb_tty.getvalue().split("\r") == [" " * 10, " " * 10, ""]
+    # No signal handler is installed behind the user's back
+    assert signal.getsignal(signal.SIGWINCH) is handler
+
+
+def test_info_progress_skips_identical_lines(always_color: None) -> None:
+    with mock.patch("sys.stdout", new_callable=SmartTTY) as stdout:
+        for i in range(1000):
+            cli_ui.info_progress("Done", i, 1000)
+        lines = stdout.getvalue().split("\r")
+    assert len(lines) == 102  # 0% to 100%, and an empty string
+    assert lines[-2] == "Done: 100%"
+
+
+def test_track(always_color: None, smart_tty: SmartTTY) -> None:
+    items = list(range(1000))
+    actual = list(cli_ui.track(items, "Processing", fileobj=smart_tty))
+    assert actual == items
+    # Too fast to be drawn more than once
+    assert smart_tty.getvalue().startswith("Processing: 100% (1000/1000)")
+    assert smart_tty.getvalue().endswith("\r\n")
+
+
+def test_progress_redraws_after_min_interval(
+    always_color: None, smart_tty: SmartTTY
+) -> None:
+    with mock.patch("time.monotonic") as monotonic:
+        monotonic.return_value = 0.0
+        progress = cli_ui.Progress("Working", total=10, fileobj=smart_tty)
+        monotonic.return_value = 2.0
+        progress.update(5)
+        assert smart_tty.getvalue() == "Working:  50% (5/10) 2.5/s ETA 0:00:02\r"
+        progress.update(1)
+        assert smart_tty.getvalue().count("\r") == 1
+
+
+def test_progress_redraws_when_items_slow_down(
+    always_color: None, smart_tty: SmartTTY
+) -> None:
+    def items() -> Iterator[bool]:
+        # A fast phase makes the next check very far away ...
+        deadline = time.monotonic() + 0.1
+        while time.monotonic() < deadline:
+            yield False
+        # ... which should not hide a slow phase
+        for _ in range(5):
+            time.sleep(0.05)
+            yield True
+
+    redraws = []
+    for slow in cli_ui.track(items(), "Working", min_interval=0.01, fileobj=smart_tty):
+        if slow:
+            redraws.append(smart_tty.getvalue().count("\r"))
+    assert redraws[-1] > redraws[0]
+
+
+def test_progress_group(always_color: None, smart_tty: SmartTTY) -> None:
+    def work(group: cli_ui.ProgressGroup, name: str) -> None:
+        progress = group.add(name, total=100)
+        for _ in range(100):
+            progress.update()
+
+    with cli_ui.ProgressGroup(fps=1000, fileobj=smart_tty) as group:
+        threads = [
+            threading.Thread(target=work, args=(group, name)) for name in ("foo", "bar")
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    # The final frame is drawn over the previous ones
+    frames = smart_tty.getvalue().split("\r")
+    last_frame = re.sub(r"\x1b\[\d*[AK]", "", frames[-1])
+    lines = sorted(last_frame.splitlines())
+    assert len(lines) == 2
+    assert lines[0].startswith("bar: 100% (100/100)")
+    assert lines[1].startswith("foo: 100% (100/100)")
+
+
+def test_progress_group_redraws_in_place(
+    always_color: None, smart_tty: SmartTTY
+) -> None:
+    group = cli_ui.ProgressGroup(fileobj=smart_tty)
+    progress = group.add("foo")
+    group.draw()
+    progress.update(3)
+    group.draw()
+    assert smart_tty.getvalue().startswith("foo: 0\x1b[K\n\r\x1b[1Afoo: 3 ")
+
+
+def test_progress_only_on_terminals(dumb_tty: DumbTTY) -> None:
+    with cli_ui.Progress("Working", fileobj=dumb_tty) as progress:
+        progress.update(10)
+    assert dumb_tty.getvalue() == ""
+
+
 def test_quiet(message_recorder: MessageRecorder) -> None:
     cli_ui.setup(quiet=True)
     cli_ui.info("info")
@@ -397,6 +1332,61 @@ def test_fatal_with_custom_code() -> None:
     assert e.value.code == 3
 
 
+def test_flood_control(message_recorder: MessageRecorder) -> None:
+    cli_ui.setup(warning_limit=2)
+    try:
+        before = cli_ui.suppressed_messages()
+        for i in range(5):
+            cli_ui.warning("Cannot read", i)
+        cli_ui.warning("Something else")
+        cli_ui.error("Not limited")
+        cli_ui.error("Not limited")
+        assert cli_ui.suppressed_messages() - before == 3
+    finally:
+        cli_ui.setup()
+    assert message_recorder.find_all("Cannot read") == [
+        "Warning: Cannot read 0\n",
+        "Warning: Cannot read 1\n",
+    ]
+    assert message_recorder.find("Something else")
+    assert message_recorder.count("Not limited", level="error") == 2
+    # The summary is displayed when the settings change
+    assert message_recorder.find(
+        r"Warning: suppressed 3 similar warnings from test_cli_ui.py:\d+$"
+    )
+
+
+def test_flood_control_window(message_recorder: MessageRecorder) -> None:
+    def read(i: int) -> None:
+        cli_ui.error("Cannot read", i)
+
+    cli_ui.setup(error_limit=1, flood_window=0.1)
+    try:
+        for i in range(3):
+            read(i)
+        time.sleep(0.15)
+        read(3)
+        errors = message_recorder.find_all("Error:")
+    finally:
+        cli_ui.setup()
+    assert len(errors) == 3
+    assert errors[0] == "Error: Cannot read 0\n"
+    assert re.match(
+        r"Error: suppressed 2 similar errors from test_cli_ui.py", errors[1]
+    )
+    assert errors[2] == "Error: Cannot read 3\n"
+
+
+def test_fatal_is_never_suppressed(message_recorder: MessageRecorder) -> None:
+    cli_ui.setup(error_limit=0)
+    try:
+        with pytest.raises(SystemExit):
+            cli_ui.fatal("Something bad happened")
+    finally:
+        cli_ui.setup()
+    assert message_recorder.find("Something bad happened")
+
+
 def test_color_always(dumb_tty: DumbTTY) -> None:
     cli_ui.setup(color="always")
     cli_ui.info(cli_ui.red, "this is red", fileobj=dumb_tty)
@@ -426,3 +1416,80 @@ def test_message_for_exception(
         "error when fooing\n",
         "ZeroDivisionError",
     )
+
+
+def test_did_you_mean() -> None:
+    actual = cli_ui.did_you_mean("Invalid name", "Joohn", ["Alice", "John", "Bob"])
+    assert actual == "Invalid name\nDid you mean: John?"
+
+
+def test_did_you_mean_ties_keep_the_first_choice() -> None:
+    actual = cli_ui.did_you_mean("Invalid", "ab", ["ax", "bb", "ab1"])
+    assert actual.endswith("Did you mean: ab1?")
+    actual = cli_ui.did_you_mean("Invalid", "xy", ["xa", "ya"])
+    assert actual.endswith("Did you mean: xa?")
+
+
+def test_suggestion_index_top_k() -> None:
+    index = cli_ui.SuggestionIndex(["spam", "eggs", "bacon", "spams", "spa"])
+    assert index.suggest("spamm", limit=3) == ["spam", "spams", "spa"]
+    assert index.suggest("spamm", limit=10, cutoff=0.5) == ["spam", "spams", "spa"]
+
+
+def test_suggestion_index_with_many_choices() -> None:
+    choices = [f"package-{i}" for i in range(5000)] + ["requests"]
+    index = cli_ui.SuggestionIndex(choices, exhaustive_limit=100)
+    assert index.suggest("reqeusts") == ["requests"]
+
+
+# Only loaded when they are used
+LAZY_MODULES = {
+    "argparse",
+    "cProfile",
+    "colorama",
+    "difflib",
+    "getpass",
+    "inspect",
+    "pstats",
+    "tabulate",
+    "traceback",
+    "tracemalloc",
+    "unidecode",
+}
+if os.name == "nt":
+    # colorama is set up when cli_ui is imported on Windows
+    LAZY_MODULES.remove("colorama")
+
+# Generous, so that the test does not fail on slow machines, but
+# still well below what importing the lazy modules used to cost
+IMPORT_TIME_BUDGET_US = 100_000
+
+
+def run_python(code: str, *args: str) -> str:
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    project_path = os.path.dirname(os.path.dirname(cli_ui.__file__))
+    env["PYTHONPATH"] = project_path
+    process = subprocess.run(
+        [sys.executable, *args, "-c", code],
+        check=True,
+        capture_output=True,
+        text=True,
+        env=env,
+    )
+    return process.stdout + process.stderr
+
+
+def test_import_does_not_load_heavy_modules() -> None:
+    output = run_python("import sys, cli_ui; print(' '.join(sys.modules))")
+    assert not LAZY_MODULES & set(output.split())
+
+
+def test_import_time_budget() -> None:
+    def import_time() -> int:
+        output = run_python("import cli_ui", "-X", "importtime")
+        (line,) = [x for x in output.splitlines() if x.endswith("| cli_ui")]
+        return int(line.split("|")[1])
+
+    # The first run may have to write the bytecode cache
+    assert min(import_time() for _ in range(3)) < IMPORT_TIME_BUDGET_US
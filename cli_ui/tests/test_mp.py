@@ -0,0 +1,65 @@
+import concurrent.futures
+import multiprocessing
+import re
+from typing import Any, Iterator
+
+import pytest
+
+import cli_ui
+from cli_ui import mp
+from cli_ui.tests.conftest import MessageRecorder
+
+
+def build(name: str) -> str:
+    for i in range(3):
+        cli_ui.info(name, end=" ")
+        cli_ui.info(i)
+    cli_ui.info_table([[(name,), ("ok",)]])
+    cli_ui.warning("slow", name)
+    return name
+
+
+@pytest.fixture
+def fork_context() -> Iterator[Any]:
+    if "fork" not in multiprocessing.get_all_start_methods():
+        pytest.skip("fork is not available")
+    yield multiprocessing.get_context("fork")
+    mp.stop()
+
+
+def run_pool(context: Any) -> None:
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=3, mp_context=context, **mp.pool_options(context)
+    ) as pool:
+        assert list(pool.map(build, ["foo", "bar", "baz"])) == ["foo", "bar", "baz"]
+    mp.stop()
+
+
+def test_lines_from_workers_are_not_mixed(
+    fork_context: Any, capsys: pytest.CaptureFixture[str]
+) -> None:
+    run_pool(fork_context)
+    lines = capsys.readouterr().out.splitlines()
+    for name in ("foo", "bar", "baz"):
+        assert [line for line in lines if re.match(name + r" \d", line)] == [
+            name + " 0",
+            name + " 1",
+            name + " 2",
+        ]
+        assert name + "  ok" in lines
+
+
+def test_parent_settings_are_applied(
+    fork_context: Any, message_recorder: MessageRecorder
+) -> None:
+    cli_ui.setup(quiet=True)
+    try:
+        run_pool(fork_context)
+    finally:
+        cli_ui.setup()
+    assert not message_recorder.find("foo 0")
+    assert message_recorder.count("slow", level="warning", stream="stderr") == 3
+
+
+def test_stop_without_workers() -> None:
+    mp.stop()
@@ -1,6 +1,6 @@
 import asyncio
 
-import cli_ui
+from cli_ui import aio
 
 
 async def long_computation():
@@ -8,38 +8,34 @@ async def long_computation():
     await asyncio.sleep(0.6)
 
 
-async def count_down(lock, start):
+async def count_down(start):
     x = start
     while x >= 0:
-        async with lock:
-            # Note: the sleeps are here so that we are more likely to
-            # see mangled output
-            #
-            # In reality, if you only call `ui.info()` once you don't
-            # need locks at all thanks to the GIL
-            cli_ui.info("down", end=" ")
-            await asyncio.sleep(0.2)
-            cli_ui.info(x)
-            await asyncio.sleep(0.2)
+        # Note: the sleep is here so that we are more likely to
+        # see mangled output.
+        #
+        # No lock is needed: cli_ui.aio keeps the beginning of the line
+        # aside until the task completes it.
+        await aio.info("down", end=" ")
+        await asyncio.sleep(0.2)
+        await aio.info(x)
         await long_computation()
         x -= 1
 
 
-async def count_up(lock, stop):
+async def count_up(stop):
     x = 0
     while x <= stop:
-        async with lock:
-            cli_ui.info("up", end=" ")
-            await asyncio.sleep(0.2)
-            cli_ui.info(x)
-            await asyncio.sleep(0.2)
+        await aio.info("up", end=" ")
+        await asyncio.sleep(0.2)
+        await aio.info(x)
         await long_computation()
         x += 1
 
 
 async def main():
-    lock = asyncio.Lock()
-    await asyncio.gather(count_down(lock, 4), count_up(lock, 4))
+    await asyncio.gather(count_down(4), count_up(4))
+    await aio.close()
 
 
 if __name__ == "__main__":
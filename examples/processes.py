@@ -0,0 +1,27 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cli_ui
+import cli_ui.mp
+
+
+def count(name, stop):
+    for x in range(stop):
+        # The worker processes do not write to stdout themselves:
+        # messages are sent to the parent process, which writes
+        # complete lines only.
+        cli_ui.info(name, end=" ")
+        time.sleep(0.2)
+        cli_ui.info(x)
+    cli_ui.info_2(name, "done")
+
+
+def main():
+    cli_ui.setup(timestamp=True)
+    with ProcessPoolExecutor(max_workers=2, **cli_ui.mp.pool_options()) as pool:
+        list(pool.map(count, ["up", "down"], [4, 4]))
+    cli_ui.mp.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,3 @@
-import threading
 import time
 from threading import Thread
 
@@ -10,39 +9,34 @@ def long_computation():
     time.sleep(0.6)
 
 
-def count_down(lock, start):
+def count_down(start):
     x = start
     while x >= 0:
-        with lock:
-            # Note: the sleeps are here so that we are more likely to
-            # see mangled output
-            #
-            # In reality, if you only call `ui.info()` once you don't
-            # need locks at all thanks to the GIL
-            cli_ui.info("down", end=" ")
-            time.sleep(0.2)
-            cli_ui.info(x)
-            time.sleep(0.2)
+        # Note: the sleep is here so that we are more likely to
+        # see mangled output.
+        #
+        # No lock is needed: cli_ui keeps the beginning of the line
+        # aside until the thread completes it.
+        cli_ui.info("down", end=" ")
+        time.sleep(0.2)
+        cli_ui.info(x)
         long_computation()
         x -= 1
 
 
-def count_up(lock, stop):
+def count_up(stop):
     x = 0
     while x <= stop:
-        with lock:
-            cli_ui.info("up", end=" ")
-            time.sleep(0.2)
-            cli_ui.info(x)
-            time.sleep(0.2)
+        cli_ui.info("up", end=" ")
+        time.sleep(0.2)
+        cli_ui.info(x)
         long_computation()
         x += 1
 
 
 def main():
-    lock = threading.Lock()
-    t1 = Thread(target=count_down, args=(lock, 4))
-    t2 = Thread(target=count_up, args=(lock, 4))
+    t1 = Thread(target=count_down, args=(4,))
+    t2 = Thread(target=count_up, args=(4,))
 
     t1.start()
     t2.start()